@@ -1,11 +1,57 @@
 from django.contrib import admin
+from django.db.models import FloatField, Sum, Value
+from django.db.models.functions import Coalesce
 from apihangar.models import (EndpointQuery,
                               EndpointPermission,
                               PrebuiltViewPermission,
                               Query,
+                              QueryStats,
                               Endpoint,
                               PrebuiltView)
 
+class QueryStatsInline(admin.StackedInline):
+    model = QueryStats
+    can_delete = False
+    readonly_fields = ("calls", "errors", "rows", "total_time", "max_time",
+                       "explain_sql", "explain", "explain_time", "explained_at")
+
+    def has_add_permission(self, request, *args):
+        return False
+
+class QueryAdmin(admin.ModelAdmin):
+    list_display = ("name", "database", "calls", "total_time", "average_time",
+                    "max_time", "rows")
+    inlines = [
+        QueryStatsInline,
+        ]
+
+    ## Most expensive first: those with the most database time overall.
+    def get_queryset(self, request):
+        return super(QueryAdmin, self).get_queryset(request).select_related(
+            "stats").annotate(total_cost=Coalesce("stats__total_time",
+                                                  Value(0.0, output_field=FloatField())))
+
+    def get_ordering(self, request):
+        return ("-total_cost",)
+
+    def _stat(name, description, order_field=None):
+        def stat(self, query):
+            try:
+                value = getattr(query.stats, name)
+            except QueryStats.DoesNotExist:
+                return None
+            return value() if callable(value) else value
+        stat.short_description = description
+        stat.admin_order_field = order_field
+        return stat
+
+    calls = _stat("calls", "calls", "stats__calls")
+    total_time = _stat("total_time", "total seconds", "total_cost")
+    average_time = _stat("average_time", "average seconds")
+    max_time = _stat("max_time", "max seconds", "stats__max_time")
+    rows = _stat("rows", "rows", "stats__rows")
+    del _stat
+
 class EndpointQueryInline(admin.StackedInline):
     model = EndpointQuery
 
@@ -13,11 +59,26 @@ class EndpointPermissionInline(admin.StackedInline):
     model = EndpointPermission
 
 class EndpointAdmin(admin.ModelAdmin):
+    list_display = ("name", "url", "total_time")
     inlines = [
         EndpointQueryInline,
         EndpointPermissionInline,
         ]
 
+    ## Ranked by the total database time of the queries they run.
+    def get_queryset(self, request):
+        return super(EndpointAdmin, self).get_queryset(request).annotate(
+            total_cost=Coalesce(Sum("endpoint_queries__query__stats__total_time"),
+                                Value(0.0, output_field=FloatField())))
+
+    def get_ordering(self, request):
+        return ("-total_cost",)
+
+    def total_time(self, endpoint):
+        return endpoint.total_cost
+    total_time.short_description = "total query seconds"
+    total_time.admin_order_field = "total_cost"
+
 class PrebuiltViewPermissionInline(admin.StackedInline):
     model = PrebuiltViewPermission
 
@@ -25,6 +86,6 @@ class PrebuiltViewAdmin(admin.ModelAdmin):
     inlines = [
         PrebuiltViewPermissionInline,
         ]
-admin.site.register(Query)
+admin.site.register(Query, QueryAdmin)
 admin.site.register(Endpoint, EndpointAdmin)
 admin.site.register(PrebuiltView, PrebuiltViewAdmin)
@@ -0,0 +1,273 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, quote_etag
+from django.utils.six.moves import cPickle as pickle
+from hashlib import md5 as md5_constructor
+import random
+import threading
+import time
+
+from apihangar.utils import json_dumps, SortedDict
+
+__all__ = ["CacheEntry", "LocalCache", "cached_call", "get_cached",
+           "broadcast_invalidation", "cache_stats",
+           "CachedResponse", "response_cache_key"]
+
+class CacheEntry(object):
+    "A cached value, and the time until which it needs no refreshing."
+    def __init__(self, value, fresh_until):
+        self.value = value
+        self.fresh_until = fresh_until
+
+    def is_fresh(self):
+        return time.time() < self.fresh_until
+
+def _settings():
+    return (getattr(settings, 'APIHANGAR_CACHE_STALE_SECONDS', 0),
+            getattr(settings, 'APIHANGAR_CACHE_JITTER', 0.1),
+            getattr(settings, 'APIHANGAR_CACHE_LOCK_SECONDS', 30))
+
+_GENERATION_KEY = "apihangar.cache.generation"
+
+class LocalCache(object):
+    """
+    A thread-safe in-process cache of fresh CacheEntries, holding values
+    of at most `max_bytes` in all (as measured pickled), and evicting
+    the least recently used entry first.  Entries are dropped once they
+    are due a refresh, and all of them whenever the generation in the
+    shared cache changes (see broadcast_invalidation).
+
+    Values are shared by every caller in the process, so they must be
+    treated as read-only.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.generation = None
+        self.checked_at = 0
+        self._data = SortedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        "Returns the fresh CacheEntry at key, or None"
+        with self._lock:
+            try:
+                entry, size = self._data.pop(key)
+            except KeyError:
+                return None
+            if not entry.is_fresh():
+                self.bytes -= size
+                return None
+            self._data[key] = (entry, size)
+            return entry
+
+    def set(self, key, entry):
+        try:
+            size = len(pickle.dumps(entry.value, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            ## Values which can't be measured aren't kept locally.
+            return
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self._data[key] = (entry, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.bytes -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def check_generation(self, cache, interval):
+        ## Empties the cache if the shared generation has moved on,
+        ## looking it up at most once every `interval` seconds.
+        now = time.time()
+        if now - self.checked_at < interval:
+            return
+        self.checked_at = now
+        generation = cache.get(_GENERATION_KEY, 0)
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+_local = [None]
+_stats_lock = threading.Lock()
+_stats = {"local": {"hits": 0, "misses": 0}, "shared": {"hits": 0, "misses": 0}}
+
+def _count(tier, outcome):
+    with _stats_lock:
+        _stats[tier][outcome] += 1
+
+def _local_cache(cache):
+    ## Returns the LocalCache in front of `cache`, up to date with
+    ## its generation, or None if APIHANGAR_LOCAL_CACHE_BYTES is unset.
+    max_bytes = getattr(settings, 'APIHANGAR_LOCAL_CACHE_BYTES', 0)
+    if not max_bytes:
+        return None
+    local = _local[0]
+    if local is None or local.max_bytes != max_bytes:
+        local = _local[0] = LocalCache(max_bytes)
+    local.check_generation(
+        cache, getattr(settings, 'APIHANGAR_LOCAL_CACHE_CHECK_SECONDS', 1))
+    return local
+
+def broadcast_invalidation(cache, keys=()):
+    """
+    Deletes `keys` from `cache`, if any are given, and empties the
+    in-process cache of every process sharing it: this one at once, and
+    the others when they next check its generation, within
+    APIHANGAR_LOCAL_CACHE_CHECK_SECONDS (default 1).
+    """
+    if keys:
+        cache.delete_many(list(keys))
+    if not cache.add(_GENERATION_KEY, 1, None):
+        try:
+            cache.incr(_GENERATION_KEY)
+        except ValueError:
+            cache.set(_GENERATION_KEY, 1, None)
+    local = _local[0]
+    if local is not None:
+        local.clear()
+        local.checked_at = 0
+
+def cache_stats():
+    "Returns the hits and misses of each cache tier in this process"
+    with _stats_lock:
+        stats = dict((tier, dict(counts)) for tier, counts in _stats.items())
+    local = _local[0]
+    stats["local"]["entries"] = len(local) if local is not None else 0
+    stats["local"]["bytes"] = local.bytes if local is not None else 0
+    return stats
+
+def _store(cache, key, value, timeout):
+    stale_seconds, jitter, lock_seconds = _settings()
+    ## Shave a random fraction off each entry's lifetime, so that
+    ## entries filled at the same moment don't all expire together.
+    fresh_seconds = timeout * (1 - random.random() * jitter)
+    entry = CacheEntry(value, time.time() + fresh_seconds)
+    cache.set(key, entry, int(fresh_seconds + stale_seconds) or 1)
+    return entry
+
+def _get(cache, local, key):
+    ## Looks the key up in the local tier and then the shared one,
+    ## keeping fresh entries found in the shared tier locally.
+    if local is not None:
+        entry = local.get(key)
+        if entry is not None:
+            _count("local", "hits")
+            return entry
+        _count("local", "misses")
+    entry = cache.get(key)
+    if not isinstance(entry, CacheEntry):
+        _count("shared", "misses")
+        return None
+    _count("shared", "hits")
+    if local is not None and entry.is_fresh():
+        local.set(key, entry)
+    return entry
+
+def get_cached(cache, key):
+    "Returns the value cached at key, fresh or stale, or None"
+    entry = _get(cache, _local_cache(cache), key)
+    if entry is not None:
+        return entry.value
+    return None
+
+def cached_call(cache, key, timeout, compute):
+    """
+    Returns the value cached at key, calling compute() to fill it in
+    when it is missing or due a refresh.
+
+    Only one caller at a time recomputes a key: it takes a lock in the
+    cache, while other callers are given the stale value if there is one
+    (values are kept for APIHANGAR_CACHE_STALE_SECONDS past their
+    `timeout`), or else wait up to APIHANGAR_CACHE_LOCK_SECONDS for the
+    lock holder to finish.  If it fails, one of the waiters takes over
+    the lock and recomputes the value.
+
+    With APIHANGAR_LOCAL_CACHE_BYTES set, fresh values are also kept in
+    a LocalCache of that size in each process, and served from there
+    without a round trip to `cache`.
+    """
+    stale_seconds, jitter, lock_seconds = _settings()
+    lock_key = "%s.lock" % key
+
+    local = _local_cache(cache)
+    entry = _get(cache, local, key)
+    if entry is not None:
+        if entry.is_fresh() or not cache.add(lock_key, 1, lock_seconds):
+            return entry.value
+    elif not cache.add(lock_key, 1, lock_seconds):
+        deadline = time.time() + lock_seconds
+        delay = 0.05
+        while True:
+            if time.time() >= deadline:
+                ## The lock holder never delivered; go ahead without it.
+                value = compute()
+                _store(cache, key, value, timeout)
+                return value
+            ## Back off, so that waiters don't hammer a shared cache.
+            time.sleep(delay * (0.5 + random.random()))
+            delay = min(delay * 2, 0.5)
+            entry = cache.get(key)
+            if isinstance(entry, CacheEntry):
+                return entry.value
+            ## If the lock holder failed it has released the lock;
+            ## the first waiter to take it over recomputes the value.
+            if cache.add(lock_key, 1, lock_seconds):
+                break
+
+    try:
+        value = compute()
+        entry = _store(cache, key, value, timeout)
+    finally:
+        cache.delete(lock_key)
+    if local is not None:
+        local.set(key, entry)
+    return value
+
+def _md5(text):
+    if not isinstance(text, bytes):
+        text = text.encode("utf-8")
+    return md5_constructor(text).hexdigest()
+
+def response_cache_key(url, response_type, request):
+    "Returns the cache key for a response to this request for an endpoint"
+    params = sorted((key, sorted(values)) for key, values in request.GET.lists())
+    return "apihangar.response.%s.%s" % (
+        _md5(url), _md5(json_dumps([response_type, params])))
+
+class CachedResponse(object):
+    """
+    The serialized body of a response, which can be served again (or
+    answered with a 304 Not Modified) for up to `timeout` seconds.
+    """
+    def __init__(self, response, timeout):
+        if hasattr(response, "render"):
+            response.render()
+        self.content = response.content
+        self.content_type = response["Content-Type"]
+        self.etag = quote_etag(md5_constructor(self.content).hexdigest())
+        self.last_modified = time.time()
+        self.expires = self.last_modified + timeout
+
+    def to_response(self, request, private=False):
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH", "")
+        if self.etag in if_none_match or if_none_match.strip() == "*":
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(self.content, content_type=self.content_type)
+        response["ETag"] = self.etag
+        response["Last-Modified"] = http_date(self.last_modified)
+        response["Cache-Control"] = "%s, max-age=%d" % (
+            "private" if private else "public",
+            max(0, self.expires - time.time()))
+        return response
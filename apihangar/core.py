@@ -1,27 +1,48 @@
-from apihangar.utils import dictfetchall
+from apihangar.governor import (acquire, release, max_rows, statement_timeout,
+                                apply_statement_timeout)
+from apihangar.instrumentation import Execution
+from apihangar.parallel import submit as submit_call
+from apihangar.routing import route
+from apihangar.singleflight import SingleFlight, coalescing
+from apihangar.sqltemplates import SQLTemplate
+from apihangar.utils import (columnfetchall, dictfetchall, fetchall, json_dumps,
+                             LRUCache, RowStream, SortedDict)
+from django.conf import settings
 from django.db import connections
-from django.template import Template, Context
-import djtemplateinspector as inspector
+from functools import partial
+from hashlib import md5 as md5_constructor
 import re
+import time
 
-__all__ = ["get_variables", "render_sql", "run"]
+__all__ = ["compile_query", "invalidate_compiled",
+           "get_variables", "result_cache_key", "render_sql", "bind_sql",
+           "Page", "Delta", "run", "submit"]
 
-def _template_get_variables(query):
+def _strip_type_prefixes(sql):
+    ## Parameters have already been type-cast as needed,
+    ## so swallow all the ad-hoc type prefixes which will
+    ## otherwise trip up the Django template machinery.
+    return sql.replace("int:", "").replace("list:", "")
+
+def _normalize_sql(sql):
+    "Collapses the SQL onto a single line, dropping blank lines"
+    return ' '.join(line.strip() for line in sql.splitlines()
+                    if line and line.strip())
+
+def _template_get_variables(sql, tmpl):
     """
     Returns an ordered list of variable names in this query's SQL,
-    by monkeypatching Django template internals to maintain a list
-    of all variables that it attempted to resolve in the template.
+    restoring the type prefixes stripped from the compiled template.
     """
-    tmpl = Template(query.sql.replace("int:", "").replace("list:", ""))
-    variables = inspector.get_variables(tmpl)
+    variables = tmpl.variables
 
     restored_variables = []
     for v in variables:
-        if "list:int:%s" % v in query.sql:
+        if "list:int:%s" % v in sql:
             restored_variables.append("list:int:%s" % v)
-        elif "int:%s" % v in query.sql:
+        elif "int:%s" % v in sql:
             restored_variables.append("int:%s" % v)
-        elif "list:%s" % v in query.sql:
+        elif "list:%s" % v in sql:
             restored_variables.append("list:%s" % v)
         else:
             restored_variables.append(v)
@@ -34,65 +55,377 @@ _format_char_to_type = {
     'a': "list:int:",
     }
 
-def _string_get_variables(query):
+_placeholder_pattern = re.compile(
+    r"%\((?P<var_name>[\w\d\-_]+)\)(?P<var_type>[sdla])")
+
+def _string_get_variables(sql):
     """
     Returns an ordered list of variable names in this query's SQL,
     by extracting %(var_name)s patterns from the raw string.
     """
-    extraction = re.findall(
-        r"%\((?P<var_name>[\w\d\-_]+)\)(?P<var_type>[sdla])", query.sql)
+    extraction = _placeholder_pattern.findall(sql)
     restored_variables = []
     for var, type in extraction:
-        restored_variables.append("%s%s" % (query._format_char_to_type[type], var))
+        restored_variables.append("%s%s" % (_format_char_to_type[type], var))
     return restored_variables
 
+class CompiledQuery(object):
+    """
+    The parsed form of one revision of a query's SQL: the template
+    (for use_templates queries), the typed variable list, and the
+    SQL text which is rendered against each request's parameters.
+    """
+    def __init__(self, query):
+        sql = query.sql
+        if not isinstance(sql, bytes):
+            sql = sql.encode("utf-8")
+        self.revision = md5_constructor(sql).hexdigest()
+        self.use_templates = query.use_templates
+        if self.use_templates:
+            self.sql = _strip_type_prefixes(query.sql)
+            self.template = SQLTemplate(self.sql)
+            self.variables = _template_get_variables(query.sql, self.template)
+        else:
+            self.sql = _normalize_sql(
+                query.sql.replace(")l", ")r").replace(")a", ")r"))
+            self.template = None
+            self.variables = _string_get_variables(query.sql)
+        ## The names of the parameters the variables are looked up by:
+        ## without type prefixes, and without attribute lookups (so that
+        ## {{ int:ids.0 }} is looked up by "ids").
+        self.names = sorted(set(v.rsplit(":", 1)[-1].split(".")[0]
+                                for v in self.variables))
+
+        self.use_bind_params = (getattr(query, "use_bind_params", False)
+                                and not self.use_templates)
+        if self.use_bind_params:
+            self._parse_placeholders(_normalize_sql(query.sql))
+
+    def _parse_placeholders(self, sql):
+        ## Split the SQL into its literal text and its %(name)x
+        ## placeholders, so that statements can be assembled with
+        ## driver-level %s parameters instead of inlined values.
+        self.literals = []
+        self.placeholders = []
+        position = 0
+        for match in _placeholder_pattern.finditer(sql):
+            self.literals.append(sql[position:match.start()])
+            self.placeholders.append((match.group("var_name"),
+                                      match.group("var_type")))
+            position = match.end()
+        self.literals.append(sql[position:])
+        self._statements = {}
+
+    def bind(self, params):
+        """
+        Returns the parameterized statement and its list of arguments.
+        List parameters are expanded into one placeholder per item; the
+        statement text is cached per combination of list lengths, so
+        repeated calls reuse the same SQL.
+        """
+        shape = tuple(len(params[name]) for name, type in self.placeholders
+                      if type in "la")
+        statement = self._statements.get(shape)
+        if statement is None:
+            statement = self._build_statement(shape)
+            if len(self._statements) < 100:
+                self._statements[shape] = statement
+
+        args = []
+        for name, type in self.placeholders:
+            if type in "la":
+                args.extend(params[name])
+            else:
+                args.append(params[name])
+        return statement, args
+
+    def _build_statement(self, shape):
+        lengths = iter(shape)
+        parts = [self.literals[0]]
+        for (name, type), literal in zip(self.placeholders, self.literals[1:]):
+            if type in "la":
+                length = next(lengths)
+                if length:
+                    parts.append("(%s)" % ", ".join(["%s"] * length))
+                else:
+                    parts.append("(NULL)")
+            else:
+                parts.append("%s")
+            parts.append(literal)
+        return "".join(parts)
+
+_compiled_queries = None
+
+def _get_compiled_queries():
+    global _compiled_queries
+    if _compiled_queries is None:
+        _compiled_queries = LRUCache(
+            getattr(settings, 'APIHANGAR_COMPILED_QUERY_CACHE_SIZE', 1000))
+    return _compiled_queries
+
+def _query_identity(query):
+    ## Saved Query models are identified by primary key; anything
+    ## else (e.g. queries in the code registry) by the object itself.
+    pk = getattr(query, "pk", None)
+    if pk is not None:
+        return (query.__class__.__name__, pk)
+    return (query.__class__.__name__, id(query))
+
+def _compile_key(query):
+    sql = query.sql
+    if not isinstance(sql, bytes):
+        sql = sql.encode("utf-8")
+    return (_query_identity(query),
+            md5_constructor(sql).hexdigest(),
+            bool(query.use_templates),
+            bool(getattr(query, "use_bind_params", False)))
+
+def compile_query(query):
+    """
+    Returns the CompiledQuery for the current revision of this query's SQL,
+    parsing it only if it has not been seen recently.
+    """
+    cache = _get_compiled_queries()
+    key = _compile_key(query)
+    compiled = cache.get(key)
+    if compiled is None:
+        compiled = CompiledQuery(query)
+        cache.set(key, compiled)
+    return compiled
+
+def invalidate_compiled(query):
+    "Drops every compiled revision of this query's SQL"
+    identity = _query_identity(query)
+    _get_compiled_queries().discard(lambda key: key[0] == identity)
+
 def get_variables(query):
-    if query.use_templates:
-        return _template_get_variables(query)
-    return _string_get_variables(query)
+    return list(compile_query(query).variables)
 
-def _template_render_sql(query, params):
-    ## Parameters have already been type-cast as needed,
-    ## so swallow all the ad-hoc type prefixes which will
-    ## otherwise trip up the Django template machinery.
-    sql = query.sql.replace("int:", "").replace("list:", "")
+def result_cache_key(query, params, return_one=False, return_list=False,
+                     result_format="dicts", page=None, incremental=None):
+    """
+    Returns the key to cache the query's result under: a digest of its
+    database, the revision of its SQL, the values of only those params
+    its variables use, and the options which shape its result (including
+    the `incremental` watermark column and row limit of incrementally
+    refreshed results).  Queries which would return the same result
+    share a key, whatever endpoint or request they are run for.
+    """
+    compiled = compile_query(query)
+    used = dict((name, params[name]) for name in compiled.names if name in params)
+    options = [query.database, compiled.revision, compiled.use_templates,
+               compiled.use_bind_params, bool(return_one), bool(return_list),
+               result_format, None]
+    if page is not None:
+        options[-1] = [page.size, page.order_by, page.after, page.number]
+    if incremental is not None:
+        options.append(list(incremental))
+    return "apihangar.result.%s" % md5_constructor(
+        json_dumps([options, used], sort_keys=True).encode("utf-8")).hexdigest()
 
-    ## Forcibly shut off Django's template safety measures
-    ## which screw up user input by escaping strings.
-    from django.utils import html
-    original_escape = html.escape
-    html.escape = lambda x: x
+def _template_render_sql(compiled, params):
+    return _normalize_sql(compiled.template.render(params))
 
-    try:
-        sql = Template(sql).render(Context(params))
-    finally:
-        html.escape = original_escape
-    return sql
-            
-def _string_render_sql(query, params):
-    sql = query.sql.replace(")l", ")r").replace(")a", ")r")
-    return sql % params
+def _string_render_sql(compiled, params):
+    return compiled.sql % params
 
 def render_sql(query, params):
-    if query.use_templates:
-        return _template_render_sql(query, params)
-    return _string_render_sql(query, params)
+    compiled = compile_query(query)
+    if compiled.use_templates:
+        return _template_render_sql(compiled, params)
+    return _string_render_sql(compiled, params)
 
-def run(query, return_one=False, return_list=False, params={}):
-    cursor = connections[query.database].cursor()
+def bind_sql(query, params):
+    """
+    Returns a (sql, args) pair ready for cursor.execute().  For queries
+    which use bind parameters the values are passed separately as args;
+    otherwise they are rendered into the SQL and args is None.
+    """
+    compiled = compile_query(query)
+    if compiled.use_bind_params:
+        return compiled.bind(params)
 
     sql = render_sql(query, params)
-    sql = ' '.join(line.strip() for line in sql.splitlines() 
-                   if line and line.strip())
     ## Python's tuple repr() will result in 1-tuples like ("foo",)
     ## but MySQL needs them to look like ("foo") instead.
     sql = sql.replace(",)", ")").replace(", )", " )")
+    return sql, None
+
+def _subselect(sql, args, alias, column=None, after=None):
+    ## Wraps the SQL as a subquery, ordered by `column` if given, and
+    ## selecting only rows whose `column` is greater than `after` if
+    ## that is given.  Returns the list of SQL clauses, and the args.
+    sql = sql.rstrip().rstrip(";")
+    if after is not None:
+        if args is None:
+            ## The SQL is about to gain a placeholder, so any literal
+            ## percent signs must be escaped from the driver.
+            sql = sql.replace("%", "%%")
+            args = []
+        args = list(args) + [after]
+    parts = ["SELECT * FROM (%s) %s" % (sql, alias)]
+    if after is not None:
+        parts.append("WHERE %s > %%s" % column)
+    if column:
+        parts.append("ORDER BY %s" % column)
+    return parts, args
+
+class Page(object):
+    """
+    One page of a query's results: at most `size` rows, ordered by the
+    result column `order_by` if given, and either following the row whose
+    `order_by` value is `after` (keyset pagination) or else starting at
+    page `number` (offset pagination).
+    """
+    def __init__(self, size, order_by=None, after=None, number=1):
+        self.size = size
+        self.order_by = order_by
+        self.after = after if order_by else None
+        self.number = number
+
+    @classmethod
+    def from_params(cls, size, order_by, params):
+        "Returns the page requested by the `page` or `after` parameter"
+        if not size:
+            return None
+        try:
+            number = max(1, int(params.get("page", 1)))
+        except (TypeError, ValueError):
+            number = 1
+        return cls(size, order_by, after=params.get("after"), number=number)
+
+    def apply(self, sql, args):
+        "Wraps the (sql, args) to be executed so that it selects this page"
+        parts, args = _subselect(sql, args, "apihangar_page", self.order_by, self.after)
+        ## Fetch one extra row to find out whether there's a next page.
+        parts.append("LIMIT %d" % (self.size + 1))
+        if self.after is None and self.number > 1:
+            parts.append("OFFSET %d" % ((self.number - 1) * self.size))
+        return " ".join(parts), args
 
-    cursor.execute(sql)
-    if return_list:
-        result = [item for sublist in cursor.fetchall() for item in sublist]
-    else:
-        result = dictfetchall(cursor)
+    def fetch(self, cursor, return_list=False, columnar=False):
+        """
+        Returns the page's rows from the executed cursor, in a dict along
+        with the `next` page's parameters (or None on the last page).
+        """
+        columns = [col[0] for col in cursor.description]
+        rows = cursor.fetchall()
+
+        next = None
+        if len(rows) > self.size:
+            rows = rows[:self.size]
+            if self.order_by in columns:
+                next = {"after": rows[-1][columns.index(self.order_by)]}
+            else:
+                next = {"page": self.number + 1}
+        self.fetched = len(rows)
+
+        if return_list:
+            result = SortedDict([("rows", [item for row in rows for item in row])])
+        elif columnar:
+            result = SortedDict([("columns", columns), ("rows", rows)])
+        else:
+            result = SortedDict([("rows", [SortedDict(zip(columns, row))
+                                           for row in rows])])
+        result["next"] = next
+        return result
+
+class Delta(object):
+    """
+    The rows of a query's results whose `column` value is greater than
+    `after` (or all of them, if it is None), in order of that column.
+    """
+    def __init__(self, column, after=None):
+        self.column = column
+        self.after = after
+
+    def apply(self, sql, args):
+        "Wraps the (sql, args) to be executed so that it selects these rows"
+        parts, args = _subselect(sql, args, "apihangar_delta", self.column, self.after)
+        return " ".join(parts), args
+
+def _finish_stream(execution, fetch_started, cleanup, stream):
+    ## Called by the stream once it's closed; the stream is passed in
+    ## rather than held, so that it doesn't refer to itself.
+    try:
+        for callback in cleanup:
+            callback()
+    finally:
+        execution.fetch_time = time.time() - fetch_started
+        execution.rows = stream.fetched
+        execution.finish()
+
+## Identical queries in flight at the same time share one execution.
+_in_flight = SingleFlight()
+
+def run(query, return_one=False, return_list=False, params={}, stream=False,
+        result_format="dicts", page=None, execution=None, delta=None):
+    """
+    Executes the query and returns a pair of the executed SQL (as a dict
+    of the "sql" and the "time" it took) and its result.
+
+    The result is a list of rows as dicts, or with a `result_format` of
+    "columns", a dict of the column names and a list of the rows as lists.
+    `return_list` and `return_one` take precedence over `result_format`.
+
+    With `stream`, rows are fetched lazily in chunks through a server-side
+    cursor where the database supports one, and the result is a RowStream
+    which must be consumed (once) to fetch them.
+
+    With a `page`, only that Page of the results is fetched, and the
+    result is a dict of its rows (as above) and the `next` page.
+
+    With a `delta` (and no `page`), only the rows that Delta selects are
+    fetched, in order of its column.
+
+    `stream` and `page` are ignored with `return_one`, and `stream`
+    is ignored with a `page`.
+
+    Unless APIHANGAR_COALESCE_QUERIES is False, a query which is already
+    running on the same database with the same SQL and arguments (from
+    another thread) isn't run again: this call waits for it and returns
+    the same result.  Streams are never shared.
+
+    If the query's database names a pool in APIHANGAR_DATABASE_POOLS,
+    it is run on one of the pool's aliases (see routing.Pool).
+
+    Timings are recorded in the `execution` (an instrumentation.Execution),
+    which is finished once the rows have been fetched.
+    """
+    if execution is None:
+        execution = Execution(query=query)
+    database = execution.database = query.database
+    if return_one:
+        page = None
+    stream = stream and not return_one and page is None
+    columnar = result_format == "columns" and not (return_one or return_list)
+
+    try:
+        sql, args = bind_sql(query, params)
+        if page is not None:
+            sql, args = page.apply(sql, args)
+        elif delta is not None:
+            sql, args = delta.apply(sql, args)
+        execute = partial(_execute, query, database, sql, args, execution,
+                          stream=stream, return_list=return_list,
+                          columnar=columnar, page=page)
+        if stream or not coalescing():
+            result = execute()
+        else:
+            key = (database, sql, None if args is None else tuple(args),
+                   return_list, columnar, page is not None,
+                   max_rows(query, database), statement_timeout(query, database))
+            (result, leader), shared = _in_flight.do(
+                key, lambda: (execute(), execution))
+            if shared:
+                execution.coalesce(leader)
+    except Exception as e:
+        if not execution.finished:
+            execution.error = e
+            execution.finish()
+        raise
+    if not stream:
+        execution.finish()
 
     if return_one:
         try:
@@ -100,5 +433,88 @@ def run(query, return_one=False, return_list=False, params={}):
         except IndexError:
             result = None
 
-    return (connections[query.database].queries.pop(0),
+    return (SortedDict([("sql", execution.sql),
+                        ("time", "%.3f" % execution.db_time)]),
             result)
+
+def submit(query, **kwargs):
+    """
+    Runs the query on the query thread pool, returning a
+    concurrent.futures.Future of what run() would return.  Takes the
+    same arguments as run(), except that results can't be streamed.
+    """
+    if kwargs.get("stream"):
+        raise ValueError("Streamed results can't be submitted")
+    return submit_call(partial(run, query, **kwargs))
+
+def _execute(query, database, sql, args, execution,
+             stream=False, return_list=False, columnar=False, page=None):
+    ## Runs the bound statement on a connection chosen by the router,
+    ## within the governor's limits, and fetches its result.
+    lease = route(database)
+    alias = execution.database = lease.alias
+    connection = connections[alias]
+    limit = max_rows(query, alias)
+
+    try:
+        token = acquire(alias)
+    except Exception:
+        lease.release()
+        raise
+    cleanup = [partial(release, token), lease.release]
+    try:
+        try:
+            apply_statement_timeout(connection, statement_timeout(query, alias))
+
+            if stream:
+                cursor = getattr(connection, "chunked_cursor", connection.cursor)()
+            else:
+                cursor = connection.cursor()
+
+            started = time.time()
+            if args is None:
+                cursor.execute(sql)
+            else:
+                cursor.execute(sql, args)
+        except Exception as e:
+            lease.failed(e)
+            raise
+        fetch_started = time.time()
+        execution.db_time = fetch_started - started
+        lease.succeeded(execution.db_time)
+        execution.sql = connection.ops.last_executed_query(cursor, sql, args)
+        execution.statement = sql
+        execution.args = args
+
+        if page is not None:
+            result = page.fetch(cursor, return_list=return_list, columnar=columnar)
+            execution.rows = page.fetched
+        elif stream:
+            ## The stream holds its turn at the database (and any statement
+            ## timeout) until it has been consumed.
+            result = RowStream(
+                cursor, flatten=return_list, raw=columnar, max_rows=limit,
+                chunk_size=getattr(settings, 'APIHANGAR_STREAM_CHUNK_SIZE', 1000),
+                on_close=[partial(_finish_stream, execution, fetch_started, cleanup)])
+            cleanup = []
+            if columnar:
+                result = SortedDict([
+                    ("columns", [col[0] for col in cursor.description]),
+                    ("rows", result),
+                ])
+        elif return_list:
+            rows = fetchall(cursor, limit)
+            execution.rows = len(rows)
+            result = [item for sublist in rows for item in sublist]
+        elif columnar:
+            result = columnfetchall(cursor, limit)
+            execution.rows = len(result["rows"])
+        else:
+            result = dictfetchall(cursor, limit)
+            execution.rows = len(result)
+        if not stream:
+            execution.fetch_time = time.time() - fetch_started
+    finally:
+        for callback in cleanup:
+            callback()
+    return result
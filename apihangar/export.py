@@ -0,0 +1,188 @@
+from django.http import StreamingHttpResponse
+from django.utils import six
+from decimal import Decimal
+import csv
+
+from apihangar.utils import RowStream, SortedDict, json_dumps
+
+__all__ = ["EXPORT_TYPES", "export_supported", "tabulate", "render_export"]
+
+EXPORT_TYPES = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow"),
+    }
+
+def export_supported(response_type):
+    "Returns whether the libraries the export type needs are installed"
+    if response_type == "arrow":
+        try:
+            import pyarrow
+        except ImportError:
+            return False
+    return True
+
+def _chunks(rows):
+    if isinstance(rows, RowStream):
+        return rows.chunks()
+    return iter([list(rows)])
+
+def tabulate(result, key):
+    """
+    Returns a query's result as a list of column names and an iterator
+    over lists of rows (as sequences of values), however it was shaped:
+    columnar (streamed or not), a page, a list of single values (named
+    after the query's key), or a single row.
+    """
+    if result is None:
+        return [], iter([])
+    if isinstance(result, dict) and "columns" in result and "rows" in result:
+        return list(result["columns"]), _chunks(result["rows"])
+    if isinstance(result, dict) and "rows" in result:
+        ## A page of rows as dicts
+        rows = list(result["rows"])
+        columns = list(rows[0].keys()) if rows else []
+        return columns, iter([[list(row.values()) for row in rows]])
+    if isinstance(result, dict):
+        return list(result.keys()), iter([[list(result.values())]])
+    if isinstance(result, RowStream) and result.flatten:
+        return [key], ([[item] for item in items] for items in result.chunks())
+    rows = list(result)
+    if rows and isinstance(rows[0], dict):
+        return list(rows[0].keys()), iter([[list(row.values()) for row in rows]])
+    return [key], iter([[[item] for item in rows]])
+
+class _Echo(object):
+    "A file-like object whose write() returns what it's given"
+    def write(self, value):
+        return value
+
+def _csv_cell(value):
+    ## The Python 2 csv module only writes bytes.
+    if six.PY2 and isinstance(value, six.text_type):
+        return value.encode("utf-8")
+    return value
+
+def _csv(columns, chunks):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([_csv_cell(column) for column in columns])
+    for rows in chunks:
+        yield "".join(writer.writerow([_csv_cell(value) for value in row])
+                      for row in rows)
+
+def _ndjson(columns, chunks):
+    for rows in chunks:
+        if rows:
+            yield "".join("%s\n" % json_dumps(SortedDict(zip(columns, row)))
+                          for row in rows)
+
+class _Collector(object):
+    "A file-like object which keeps what's written to it until taken"
+    mode = "wb"
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+def _arrow(pa, columns, chunks):
+    ## The schema is inferred from the first chunk of rows; columns
+    ## which are entirely null there are written as strings, and
+    ## decimal columns as wide as Arrow allows.
+    sink = _Collector()
+    writer = None
+    schema = None
+    for rows in chunks:
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+        if schema is None:
+            schema = pa.schema([(name, _arrow_type(pa, pa.array(column).type))
+                                for name, column in zip(columns, values)])
+            writer = pa.RecordBatchStreamWriter(sink, schema)
+        batch = pa.RecordBatch.from_arrays(
+            [_arrow_array(pa, column, field.type) for column, field in zip(values, schema)],
+            schema=schema)
+        writer.write_batch(batch)
+        yield sink.take()
+    if writer is None:
+        writer = pa.RecordBatchStreamWriter(
+            sink, pa.schema([(column, pa.string()) for column in columns]))
+    writer.close()
+    yield sink.take()
+
+_ARROW_DECIMAL_PRECISION = 38
+
+def _arrow_type(pa, inferred):
+    if pa.types.is_null(inferred):
+        return pa.string()
+    if pa.types.is_decimal(inferred):
+        ## The precision inferred from one chunk is often too narrow
+        ## for the next; keep its scale, with all the precision there is.
+        return pa.decimal128(_ARROW_DECIMAL_PRECISION,
+                             min(inferred.scale, _ARROW_DECIMAL_PRECISION))
+    return inferred
+
+def _fit_decimal(value, scale):
+    ## Rounds Decimals with more places than the column has.
+    if (isinstance(value, Decimal) and value.is_finite()
+            and -value.as_tuple().exponent > scale):
+        return value.quantize(Decimal(1).scaleb(-scale))
+    return value
+
+def _arrow_array(pa, column, type):
+    ## Later chunks must fit the schema the stream was started with.
+    if pa.types.is_string(type):
+        column = [_text(value) for value in column]
+    elif pa.types.is_decimal(type):
+        column = [_fit_decimal(value, type.scale) for value in column]
+    try:
+        return pa.array(column, type=type)
+    except (pa.ArrowException, TypeError, ValueError, OverflowError):
+        ## The headers are long gone, so rather than fail the download
+        ## partway through, write the values which don't fit as nulls.
+        return pa.array([value if _arrow_fits(pa, value, type) else None
+                         for value in column], type=type)
+
+def _arrow_fits(pa, value, type):
+    try:
+        pa.array([value], type=type)
+        return True
+    except (pa.ArrowException, TypeError, ValueError, OverflowError):
+        return False
+
+def _text(value):
+    if value is None or isinstance(value, six.string_types):
+        return value
+    return "%s" % value
+
+def render_export(response_type, filename, columns, chunks):
+    """
+    Returns a streaming response writing the rows in chunks as CSV,
+    newline-delimited JSON objects, or an Arrow IPC stream (which needs
+    pyarrow; see export_supported).
+    """
+    content_type, extension = EXPORT_TYPES[response_type]
+    if response_type == "csv":
+        content = _csv(columns, chunks)
+    elif response_type == "ndjson":
+        content = _ndjson(columns, chunks)
+    else:
+        import pyarrow
+        content = _arrow(pyarrow, columns, chunks)
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response["Content-Disposition"] = 'attachment; filename="%s.%s"' % (
+        filename, extension)
+    return response
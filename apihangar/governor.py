@@ -0,0 +1,175 @@
+from django.conf import settings
+import threading
+import time
+
+__all__ = ["QueryRejected", "RowLimitExceeded",
+           "acquire", "release", "statement_timeout", "max_rows",
+           "apply_statement_timeout"]
+
+class QueryRejected(Exception):
+    """
+    Raised when a database already has as many queries in flight as it
+    is allowed, and the queue of queries waiting for it is full or the
+    wait took too long.
+    """
+
+class RowLimitExceeded(Exception):
+    "Raised when a query returns more rows than it is allowed"
+
+def _per_alias(setting, alias, default=None):
+    ## Settings may be given once for all databases,
+    ## or as a dict of values per database alias.
+    value = getattr(settings, setting, default)
+    if isinstance(value, dict):
+        return value.get(alias, default)
+    return value
+
+class _Gate(object):
+    "Admits at most `limit` queries at once, queueing the rest"
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, queue_size, timeout):
+        with self.condition:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return
+            if queue_size is not None and self.waiting >= queue_size:
+                raise QueryRejected("Too many queries waiting")
+            self.waiting += 1
+            try:
+                deadline = time.time() + timeout
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise QueryRejected("Timed out waiting to run query")
+                    self.condition.wait(remaining)
+                self.in_flight += 1
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+_gates = {}
+_gates_lock = threading.Lock()
+_held = threading.local()
+
+def _gate(alias):
+    limit = _per_alias('APIHANGAR_MAX_CONCURRENT_QUERIES', alias)
+    if not limit:
+        return None
+    with _gates_lock:
+        gate = _gates.get(alias)
+        if gate is None or gate.limit != limit:
+            gate = _gates[alias] = _Gate(limit)
+    return gate
+
+def acquire(alias):
+    """
+    Waits for a turn to run a query against the database alias, if it
+    has an APIHANGAR_MAX_CONCURRENT_QUERIES limit in this process.
+    Raises QueryRejected if APIHANGAR_MAX_QUEUED_QUERIES queries are
+    already waiting, or after APIHANGAR_QUERY_QUEUE_SECONDS.  Returns a
+    token to pass to release() when the query is done.
+
+    Turns are counted per thread, since each thread has a single
+    connection to each database: a thread which already holds a turn
+    (e.g. for a streamed result it hasn't finished) doesn't need another.
+    """
+    gate = _gate(alias)
+    if gate is None:
+        return None
+    held = _held.__dict__.setdefault(alias, [None, 0])
+    if held[1] == 0:
+        gate.acquire(_per_alias('APIHANGAR_MAX_QUEUED_QUERIES', alias),
+                     _per_alias('APIHANGAR_QUERY_QUEUE_SECONDS', alias, 10))
+        held[0] = gate
+    held[1] += 1
+    return held
+
+def release(token):
+    if token is None:
+        return
+    token[1] -= 1
+    if token[1] == 0:
+        token[0].release()
+
+def statement_timeout(query, alias):
+    "Returns the number of seconds the query may run for, or None"
+    seconds = getattr(query, "timeout_seconds", None)
+    if seconds is None:
+        seconds = _per_alias('APIHANGAR_STATEMENT_TIMEOUTS', alias)
+    return seconds
+
+def max_rows(query, alias):
+    "Returns the number of rows the query may return, or None"
+    rows = getattr(query, "max_rows", None)
+    if rows is None:
+        rows = _per_alias('APIHANGAR_MAX_ROWS', alias)
+    return rows
+
+## How each database is told to cancel statements after a time: the
+## statement to set the limit, the limit's unit (per second), and the
+## statement to lift it.
+_timeout_statements = {
+    "postgresql": ("SET statement_timeout = %d", 1000,
+                   "SET statement_timeout = DEFAULT"),
+    "mysql": ("SET SESSION max_execution_time = %d", 1000,
+              "SET SESSION max_execution_time = DEFAULT"),
+    "mariadb": ("SET SESSION max_statement_time = %d", 1,
+                "SET SESSION max_statement_time = DEFAULT"),
+    }
+
+## The limit applied to a connection isn't known, e.g. because it
+## was set inside a transaction which may yet be rolled back.
+_UNKNOWN = object()
+
+def _dialect(connection):
+    ## MariaDB reports itself as "mysql", but has no max_execution_time.
+    if connection.vendor != "mysql":
+        return connection.vendor
+    mariadb = getattr(connection, "mysql_is_mariadb", None)
+    if mariadb is None:
+        mariadb = "mariadb" in connection.connection.get_server_info().lower()
+    return "mariadb" if mariadb else "mysql"
+
+def apply_statement_timeout(connection, seconds):
+    """
+    Limits statements on the connection to the given number of seconds,
+    or lifts the limit with None, returning whether the database
+    supports doing so (only PostgreSQL, MySQL and MariaDB do).
+
+    The limit is remembered per connection, so that it is only sent to
+    the database when it changes; it stays in place for whatever else
+    runs on the connection until then.
+    """
+    if connection.vendor not in ("postgresql", "mysql"):
+        return False
+    connection.ensure_connection()
+    raw = connection.connection
+    applied = getattr(connection, "_apihangar_timeout", None)
+    if applied is not None and applied[0] is raw:
+        current = applied[1]
+    else:
+        ## A new connection has the database's default.
+        current = None
+
+    statements = _timeout_statements[_dialect(connection)]
+    limit = int(seconds * statements[1]) if seconds else None
+    if limit is not None and limit < 1:
+        limit = 1
+    if limit != current:
+        with connection.cursor() as cursor:
+            if limit is None:
+                cursor.execute(statements[2])
+            else:
+                cursor.execute(statements[0] % limit)
+        connection._apihangar_timeout = (
+            raw, _UNKNOWN if connection.in_atomic_block else limit)
+    return True
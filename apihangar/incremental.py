@@ -0,0 +1,136 @@
+from django.conf import settings
+from django.utils import six
+from django.utils.dateparse import parse_date, parse_datetime
+from decimal import Decimal, InvalidOperation
+import datetime
+import time
+
+from apihangar.core import Delta
+from apihangar.utils import SortedDict
+
+__all__ = ["IncrementalBase", "refresh_incremental", "rows_since"]
+
+class IncrementalBase(object):
+    """
+    An incrementally refreshed result, in order of its watermark column;
+    the greatest watermark in it; when it was last fully computed; and
+    whether older rows have been trimmed from it.
+    """
+    def __init__(self, result, watermark, created, trimmed=False):
+        self.result = result
+        self.watermark = watermark
+        self.created = created
+        self.trimmed = trimmed
+
+def _base_key(cache_key):
+    return "%s.base" % cache_key
+
+def _rows(result):
+    if isinstance(result, dict):
+        return result["rows"]
+    return result
+
+def _with_rows(result, rows):
+    if isinstance(result, dict):
+        result = SortedDict(result)
+        result["rows"] = rows
+        return result
+    return rows
+
+def _getter(result, column):
+    ## Returns a function giving the watermark of one of the result's rows.
+    if isinstance(result, dict):
+        index = list(result["columns"]).index(column)
+        return lambda row: row[index]
+    return lambda row: row[column]
+
+def refresh_incremental(run, cache, cache_key, column, max_rows=None):
+    """
+    Returns the (info, result) pair of an incrementally refreshed query,
+    for cached_call() to store under cache_key.
+
+    `run` is called with a `delta` keyword argument and returns the
+    query's (info, result) pair, as core.run() does.  The first time,
+    and every APIHANGAR_INCREMENTAL_SECONDS (default 86400) after that,
+    all of the query's rows are fetched; otherwise only those whose
+    `column` is greater than the last watermark seen are, and they are
+    appended to the previous result.  Only the last `max_rows` rows are
+    kept, if it is given.
+    """
+    rebuild_seconds = getattr(settings, 'APIHANGAR_INCREMENTAL_SECONDS', 86400)
+    base = cache.get(_base_key(cache_key))
+    if (not isinstance(base, IncrementalBase)
+            or time.time() - base.created >= rebuild_seconds):
+        base = None
+        info, result = run(delta=Delta(column))
+        created, trimmed = time.time(), False
+    else:
+        info, delta = run(delta=Delta(column, base.watermark))
+        result = _with_rows(base.result, list(_rows(base.result)) + list(_rows(delta)))
+        created, trimmed = base.created, base.trimmed
+
+    rows = _rows(result)
+    if max_rows is not None and len(rows) > max_rows:
+        result = _with_rows(result, rows[len(rows) - max_rows:])
+        rows, trimmed = _rows(result), True
+    if rows:
+        watermark = _getter(result, column)(rows[-1])
+    else:
+        watermark = base.watermark if base is not None else None
+
+    cache.set(_base_key(cache_key), IncrementalBase(result, watermark, created, trimmed),
+              rebuild_seconds)
+    return info, result
+
+def _coerce(value, example):
+    ## Converts a `since` parameter to the type of the watermarks it's
+    ## compared with, raising ValueError if it can't be.
+    if value is None or isinstance(value, type(example)):
+        return value
+    if isinstance(example, bool):
+        raise ValueError(value)
+    if isinstance(example, six.integer_types):
+        return int(value)
+    if isinstance(example, float):
+        return float(value)
+    if isinstance(example, Decimal):
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            raise ValueError(value)
+    if isinstance(example, datetime.datetime):
+        parsed = parse_datetime("%s" % value)
+    elif isinstance(example, datetime.date):
+        parsed = parse_date("%s" % value)
+    elif isinstance(example, six.string_types):
+        return "%s" % value
+    else:
+        raise ValueError(value)
+    if parsed is None:
+        raise ValueError(value)
+    return parsed
+
+def rows_since(output, run, cache, cache_key, column, since):
+    """
+    Returns the (info, result) pair of an incrementally refreshed query
+    with only the rows of its result whose `column` is greater than
+    `since`.  They are taken from the result where it holds them all;
+    otherwise (when older rows have been trimmed from it, or `since`
+    can't be compared with its watermarks) they are fetched by calling
+    `run` with a `delta` keyword argument.
+    """
+    info, result = output
+    rows = _rows(result)
+    if not rows:
+        return output
+    watermark = _getter(result, column)
+    try:
+        since = _coerce(since, watermark(rows[0]))
+    except (TypeError, ValueError):
+        return run(delta=Delta(column, since))
+
+    base = cache.get(_base_key(cache_key))
+    trimmed = not isinstance(base, IncrementalBase) or base.trimmed
+    if trimmed and since < watermark(rows[0]):
+        return run(delta=Delta(column, since))
+    return info, _with_rows(result, [row for row in rows if watermark(row) > since])
@@ -0,0 +1,174 @@
+from collections import deque
+from django.conf import settings
+from django.dispatch import Signal
+import threading
+import time
+
+__all__ = ["query_executed", "response_rendered", "Execution",
+           "record_response", "server_timing", "metrics"]
+
+## Sent with the Execution of every query run (or served from the
+## cache) for an endpoint, once its results have been fetched.
+query_executed = Signal(providing_args=["execution"])
+
+## Sent for every endpoint response, once it has been serialized.
+response_rendered = Signal(providing_args=["endpoint", "response_type",
+                                           "bytes", "seconds"])
+
+class Execution(object):
+    """
+    Measurements of one run of a query for an endpoint: the database and
+    SQL it ran (as executed, and as the `statement` given to the driver
+    with its `args`, if bind parameters were used), the seconds
+    spent executing the statement (`db_time`), fetching its rows
+    (`fetch_time`) and altogether (`wall_time`), the number of `rows`,
+    whether its result came from the cache ("hit", "miss", or None if it
+    isn't cached) or was shared with an identical execution
+    ("coalesced"), and the `error` it raised, if any.
+    """
+    def __init__(self, endpoint=None, key=None, query=None):
+        self.endpoint = endpoint
+        self.key = key
+        self.query = query
+        self.database = None
+        self.sql = None
+        self.statement = None
+        self.args = None
+        self.db_time = 0.0
+        self.fetch_time = 0.0
+        self.wall_time = None
+        self.rows = None
+        self.cache = None
+        self.error = None
+        self.started = time.time()
+        self.finished = False
+
+    def coalesce(self, leader):
+        "Records that this execution shared the result of `leader`"
+        self.database = leader.database
+        self.sql = leader.sql
+        self.statement = leader.statement
+        self.args = leader.args
+        self.rows = leader.rows
+        self.cache = "coalesced"
+
+    def finish(self):
+        "Records the execution and sends query_executed, once only"
+        if self.finished:
+            return
+        self.finished = True
+        self.wall_time = time.time() - self.started
+        metrics.record_execution(self)
+        query_executed.send(sender=Execution, execution=self)
+
+def record_response(endpoint, response_type, bytes, seconds):
+    metrics.record_response(endpoint, response_type, bytes, seconds)
+    response_rendered.send(sender=Execution, endpoint=endpoint,
+                           response_type=response_type,
+                           bytes=bytes, seconds=seconds)
+
+def server_timing(executions, serialize_time=None):
+    """
+    Returns a Server-Timing header value summarizing the executions
+    of an endpoint's queries, if APIHANGAR_SERVER_TIMING is set.
+    """
+    if not getattr(settings, 'APIHANGAR_SERVER_TIMING', False):
+        return None
+    hits = len([e for e in executions if e.cache == "hit"])
+    parts = [
+        'db;dur=%.1f' % (1000 * sum(e.db_time for e in executions)),
+        'fetch;dur=%.1f' % (1000 * sum(e.fetch_time for e in executions)),
+        'cache;desc="%d/%d hits"' % (hits, len(executions)),
+        ]
+    if serialize_time is not None:
+        parts.append('serialize;dur=%.1f' % (1000 * serialize_time))
+    return ", ".join(parts)
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class _Series(object):
+    "Running totals, and a window of recent samples, for one measurement"
+    def __init__(self, size):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=size)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def summary(self):
+        samples = list(self.samples)
+        return {
+            "count": self.count,
+            "total": self.total,
+            "p50": _percentile(samples, 0.50),
+            "p95": _percentile(samples, 0.95),
+            "p99": _percentile(samples, 0.99),
+            }
+
+class Metrics(object):
+    """
+    In-process aggregates of query executions, per endpoint and query
+    key, and of responses, per endpoint and response type.  Percentiles
+    are taken over the most recent APIHANGAR_METRICS_SAMPLES of each.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._queries = {}
+            self._responses = {}
+
+    def _series(self, table, key, names):
+        entry = table.get(key)
+        if entry is None:
+            size = getattr(settings, 'APIHANGAR_METRICS_SAMPLES', 1000)
+            entry = table[key] = dict((name, _Series(size)) for name in names)
+            entry["counts"] = {}
+        return entry
+
+    def record_execution(self, execution):
+        with self._lock:
+            entry = self._series(self._queries, (execution.endpoint, execution.key),
+                                 ("wall_time", "db_time", "fetch_time", "rows"))
+            entry["wall_time"].add(execution.wall_time)
+            if execution.cache not in ("hit", "coalesced"):
+                entry["db_time"].add(execution.db_time)
+                entry["fetch_time"].add(execution.fetch_time)
+            if execution.rows is not None:
+                entry["rows"].add(execution.rows)
+            outcome = "error" if execution.error is not None else (execution.cache or "uncached")
+            entry["counts"][outcome] = entry["counts"].get(outcome, 0) + 1
+
+    def record_response(self, endpoint, response_type, bytes, seconds):
+        with self._lock:
+            entry = self._series(self._responses, (endpoint, response_type),
+                                 ("serialize_time", "bytes"))
+            entry["serialize_time"].add(seconds)
+            entry["bytes"].add(bytes)
+
+    def summary(self):
+        "Returns all the aggregates as a JSON-serializable dict"
+        def summarize(table, names):
+            return [
+                dict([(names[0], key[0]), (names[1], key[1]),
+                      ("counts", dict(entry["counts"]))] +
+                     [(name, series.summary()) for name, series in entry.items()
+                      if name != "counts"])
+                for key, entry in sorted(table.items(), key=lambda item: repr(item[0]))
+                ]
+        with self._lock:
+            return {
+                "queries": summarize(self._queries, ("endpoint", "key")),
+                "responses": summarize(self._responses, ("endpoint", "response_type")),
+                }
+
+metrics = Metrics()
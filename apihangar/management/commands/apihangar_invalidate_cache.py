@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+
+from apihangar.caching import broadcast_invalidation
+
+class Command(BaseCommand):
+    help = ("Empties the in-process result cache of every process, and deletes "
+            "any keys given from APIHANGAR_CACHE.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("keys", nargs="*", metavar="key",
+                            help="also delete these keys from the shared cache")
+
+    def handle(self, *args, **options):
+        cache = caches[getattr(settings, 'APIHANGAR_CACHE', "default")]
+        broadcast_invalidation(cache, options["keys"])
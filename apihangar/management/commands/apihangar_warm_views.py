@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+import time
+
+from apihangar.warming import warm_views
+
+class Command(BaseCommand):
+    help = ("Refreshes the stored results of PrebuiltViews with a refresh_seconds "
+            "which are missing or out of date.  Run it from cron, or with --loop "
+            "as a long-running worker.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("urls", nargs="*", metavar="url",
+                            help="only warm the views at these urls")
+        parser.add_argument("--force", action="store_true",
+                            help="warm views even if their results are up to date")
+        parser.add_argument("--loop", action="store_true",
+                            help="keep warming views as they come due")
+        parser.add_argument("--interval", type=float, default=5,
+                            help="seconds between checks with --loop (default 5)")
+
+    def handle(self, *args, **options):
+        force = options["force"]
+        while True:
+            try:
+                warmed = warm_views(options["urls"], force=force)
+            except Exception as e:
+                ## Say, the database is unavailable; try again next time
+                ## round rather than leave every view to go stale.
+                if not options["loop"]:
+                    raise
+                self.stderr.write("Couldn't warm views: %s" % e)
+                warmed = []
+            for view in warmed:
+                if options["verbosity"] > 1:
+                    self.stdout.write("Warmed %s" % view.url)
+            if not options["loop"]:
+                break
+            force = False
+            close_old_connections()
+            time.sleep(options["interval"])
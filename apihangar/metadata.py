@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.core.cache import caches
+import threading
+
+from apihangar.models import Endpoint, PrebuiltView
+from apihangar.registry import registry
+
+__all__ = ["resolve_endpoint", "resolve_view", "invalidate_metadata"]
+
+VERSION_KEY = "apihangar.metadata.version"
+
+_resolved = {}
+_version = None
+_generation = 0
+_lock = threading.Lock()
+
+def _shared_cache():
+    cache_name = getattr(settings, 'APIHANGAR_METADATA_CACHE',
+                         getattr(settings, 'APIHANGAR_CACHE', "default"))
+    if cache_name is None:
+        return None
+    return caches[cache_name]
+
+def _clear():
+    global _generation
+    with _lock:
+        _resolved.clear()
+        _generation += 1
+
+def _check_version():
+    ## Edits made in any process bump a version counter in the shared
+    ## cache; a changed counter means our own copy of the metadata is
+    ## out of date.
+    global _version
+    cache = _shared_cache()
+    if cache is None:
+        return
+    version = cache.get(VERSION_KEY)
+    if version != _version:
+        _clear()
+        _version = version
+
+def invalidate_metadata():
+    """
+    Forgets all resolved endpoints in this process, and in every other
+    process sharing the APIHANGAR_METADATA_CACHE.
+    """
+    _clear()
+    cache = _shared_cache()
+    if cache is not None:
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            cache.set(VERSION_KEY, 1, None)
+
+def resolve_endpoint(url):
+    """
+    Returns the registered or stored Endpoint at this url.  Stored
+    endpoints are loaded with their queries, compiled SQL and required
+    permissions, and are kept per process until any apihangar model
+    is saved or deleted.
+    """
+    endpoint = registry.get(url)
+    if endpoint is not None:
+        return endpoint
+    return _resolve(("endpoint", url), Endpoint.objects.all(), url)
+
+def resolve_view(url):
+    """
+    Returns the PrebuiltView at this url, loaded and kept per process
+    just as resolve_endpoint does for endpoints.
+    """
+    return _resolve(("view", url), PrebuiltView.objects.select_related("endpoint"), url)
+
+def _resolve(key, queryset, url):
+    _check_version()
+    obj = _resolved.get(key)
+    if obj is None:
+        generation = _generation
+        obj = queryset.get(url=url)
+        obj.prefetch()
+        ## Don't keep what we loaded if it was invalidated meanwhile.
+        with _lock:
+            if generation == _generation:
+                _resolved[key] = obj
+    return obj
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Endpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=250)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('url', models.CharField(max_length=250, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EndpointPermission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('endpoint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='required_permissions', to='apihangar.Endpoint')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.Group')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EndpointQuery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=50)),
+                ('return_one', models.BooleanField(default=False)),
+                ('return_list', models.BooleanField(default=False)),
+                ('cache_timeout_seconds', models.IntegerField(blank=True, default=None, null=True)),
+                ('endpoint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='endpoint_queries', to='apihangar.Endpoint')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PrebuiltView',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=250, unique=True)),
+                ('response_type', models.CharField(default='json', max_length=15)),
+                ('template', models.CharField(blank=True, max_length=250, null=True)),
+                ('params', models.TextField(blank=True, null=True)),
+                ('endpoint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='prebuilt_views', to='apihangar.Endpoint')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PrebuiltViewPermission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.Group')),
+                ('view', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='required_permissions', to='apihangar.PrebuiltView')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Query',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=250)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('sql', models.TextField()),
+                ('database', models.CharField(max_length=50)),
+                ('use_templates', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='endpointquery',
+            name='query',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='endpoint_queries', to='apihangar.Query'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='endpointquery',
+            unique_together=set([('query', 'endpoint', 'key')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apihangar', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='query',
+            name='use_bind_params',
+            field=models.BooleanField(default=False, help_text='Pass %(name)s placeholders to the database as bind parameters rather than interpolating them into the SQL. Placeholders must not be quoted.  Ignored when use_templates is set.'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apihangar', '0002_query_use_bind_params'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='endpoint',
+            name='concurrent_queries',
+            field=models.NullBooleanField(help_text="Run this endpoint's queries concurrently in a thread pool.  Leave unset to use the site-wide APIHANGAR_CONCURRENT_QUERIES setting."),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apihangar', '0003_endpoint_concurrent_queries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='endpointquery',
+            name='result_format',
+            field=models.CharField(choices=[('dicts', 'A list of rows as dicts'), ('columns', 'A list of column names and a list of rows as lists')], default='dicts', help_text='The shape of the result; may be overridden per request with the format parameter.  Ignored with return_one or return_list.', max_length=15),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apihangar', '0004_endpointquery_result_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='endpoint',
+            name='response_cache_seconds',
+            field=models.IntegerField(blank=True, default=None, help_text="Cache this endpoint's serialized responses for this many seconds, and answer conditional requests for unchanged responses with 304 Not Modified.", null=True),
+        ),
+    ]
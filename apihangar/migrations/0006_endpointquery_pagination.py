@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apihangar', '0005_endpoint_response_cache_seconds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='endpointquery',
+            name='page_size',
+            field=models.IntegerField(blank=True, default=None, help_text='Return at most this many rows at a time, with the parameters for the next page.  Pages are chosen with the page parameter, or with after when order_by is set.', null=True),
+        ),
+        migrations.AddField(
+            model_name='endpointquery',
+            name='order_by',
+            field=models.CharField(blank=True, help_text="A column of the query's result to order pages by; the next page is the rows whose value is greater than the after parameter.", max_length=250, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apihangar', '0006_endpointquery_pagination'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='query',
+            name='timeout_seconds',
+            field=models.FloatField(blank=True, default=None, help_text="Cancel the query if it runs for longer than this (on PostgreSQL and MySQL).  Defaults to the database's APIHANGAR_STATEMENT_TIMEOUTS setting.", null=True),
+        ),
+        migrations.AddField(
+            model_name='query',
+            name='max_rows',
+            field=models.IntegerField(blank=True, default=None, help_text='Fail rather than return more than this many rows.  Defaults to the APIHANGAR_MAX_ROWS setting.', null=True),
+        ),
+    ]
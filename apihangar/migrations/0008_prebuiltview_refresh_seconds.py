@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apihangar', '0007_query_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prebuiltview',
+            name='refresh_seconds',
+            field=models.IntegerField(blank=True, default=None, help_text='Serve this view from a copy of its results which the apihangar_warm_views command refreshes every this many seconds.  Leave unset to run the endpoint on every request.', null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apihangar', '0008_prebuiltview_refresh_seconds'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('calls', models.BigIntegerField(default=0)),
+                ('errors', models.BigIntegerField(default=0)),
+                ('rows', models.BigIntegerField(default=0)),
+                ('total_time', models.FloatField(default=0)),
+                ('max_time', models.FloatField(default=0)),
+                ('explain', models.TextField(blank=True, null=True)),
+                ('explain_sql', models.TextField(blank=True, null=True)),
+                ('explain_time', models.FloatField(blank=True, null=True)),
+                ('explained_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'query stats',
+            },
+        ),
+        migrations.AddField(
+            model_name='querystats',
+            name='query',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='apihangar.Query'),
+        ),
+    ]
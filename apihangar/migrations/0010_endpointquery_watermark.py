@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 05:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apihangar', '0009_querystats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='endpointquery',
+            name='watermark_column',
+            field=models.CharField(blank=True, help_text="A column of the query's result whose values only ever increase.  When set, the since parameter returns only rows whose value is greater than it, and a cached result is refreshed by fetching only the new rows.  Ignored with return_one, return_list or a page_size.", max_length=250, null=True),
+        ),
+        migrations.AddField(
+            model_name='endpointquery',
+            name='max_cached_rows',
+            field=models.IntegerField(blank=True, default=None, help_text='Keep at most this many of the newest rows in an incrementally refreshed result.', null=True),
+        ),
+    ]
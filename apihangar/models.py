@@ -2,10 +2,18 @@ from django.conf import settings
 from django.core.cache import caches
 from django.db import connections
 from django.db import models
-from hashlib import md5 as md5_constructor
+from django.db.models.signals import post_delete, post_save
+from functools import partial
 
-from apihangar.core import get_variables, render_sql, run
-from apihangar.utils import json_dumps, json_loads
+from apihangar.core import (compile_query, get_variables, invalidate_compiled,
+                            render_sql, result_cache_key, run, Delta, Page)
+from apihangar.caching import cached_call, get_cached
+from apihangar.incremental import refresh_incremental, rows_since
+from apihangar.instrumentation import Execution, query_executed
+from apihangar.parallel import use_concurrency
+from apihangar.querystats import record_query_stats
+from apihangar.singleflight import run_deduplicated, submit_deduplicated
+from apihangar.utils import json_loads, RESULT_FORMATS
 
 class Query(models.Model):
     name = models.CharField(max_length=250)
@@ -16,24 +24,86 @@ class Query(models.Model):
                                 choices=settings.APIHANGAR_DATABASES)
 
     use_templates = models.BooleanField(default=False)
+    use_bind_params = models.BooleanField(
+        default=False,
+        help_text=("Pass %(name)s placeholders to the database as bind "
+                   "parameters rather than interpolating them into the SQL. "
+                   "Placeholders must not be quoted.  Ignored when "
+                   "use_templates is set."))
+
+    timeout_seconds = models.FloatField(
+        null=True, blank=True, default=None,
+        help_text=("Cancel the query if it runs for longer than this (on "
+                   "PostgreSQL and MySQL).  Defaults to the database's "
+                   "APIHANGAR_STATEMENT_TIMEOUTS setting."))
+    max_rows = models.IntegerField(
+        null=True, blank=True, default=None,
+        help_text=("Fail rather than return more than this many rows.  "
+                   "Defaults to the APIHANGAR_MAX_ROWS setting."))
 
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        super(Query, self).save(*args, **kwargs)
+        invalidate_compiled(self)
+
     def get_variables(self):
         return get_variables(self)
     
     def render_sql(self, params):
         return render_sql(self, params)
 
-    def run(self, return_one=False, return_list=False, params={}):
-        return run(self, return_one=return_one, return_list=return_list, params=params)
+    def run(self, return_one=False, return_list=False, params={}, stream=False,
+            result_format="dicts", page=None, execution=None, delta=None):
+        return run(self, return_one=return_one, return_list=return_list, params=params,
+                   stream=stream, result_format=result_format, page=page,
+                   execution=execution, delta=delta)
+
+class QueryStats(models.Model):
+    """
+    Running totals of a Query's executions against the database (cache
+    hits and coalesced executions aren't counted), and the EXPLAIN
+    output of its most recent slow execution.
+    """
+    query = models.OneToOneField(Query, related_name="stats")
+    calls = models.BigIntegerField(default=0)
+    errors = models.BigIntegerField(default=0)
+    rows = models.BigIntegerField(default=0)
+    total_time = models.FloatField(default=0)
+    max_time = models.FloatField(default=0)
+
+    explain = models.TextField(null=True, blank=True)
+    explain_sql = models.TextField(null=True, blank=True)
+    explain_time = models.FloatField(null=True, blank=True)
+    explained_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = "query stats"
+
+    def __unicode__(self):
+        return "Stats for %s" % self.query
+
+    def average_time(self):
+        if not self.calls:
+            return None
+        return self.total_time / self.calls
 
 class Endpoint(models.Model):
     name = models.CharField(max_length=250)
     description = models.TextField(null=True, blank=True)
     url = models.CharField(max_length=250, unique=True)
 
+    concurrent_queries = models.NullBooleanField(
+        help_text=("Run this endpoint's queries concurrently in a thread "
+                   "pool.  Leave unset to use the site-wide "
+                   "APIHANGAR_CONCURRENT_QUERIES setting."))
+    response_cache_seconds = models.IntegerField(
+        null=True, blank=True, default=None,
+        help_text=("Cache this endpoint's serialized responses for this "
+                   "many seconds, and answer conditional requests for "
+                   "unchanged responses with 304 Not Modified."))
+
     def __unicode__(self):
         return "'%s' at %s" % (self.name, self.get_absolute_url())
 
@@ -55,19 +125,85 @@ class Endpoint(models.Model):
 
     get_absolute_url = execute_endpoint_json_url
 
-    def run(self, params={}):
+    def prefetch(self):
+        """
+        Loads this endpoint's queries (compiling their SQL) and its
+        required permissions, so that running it needs no further
+        metadata queries.
+        """
+        self._endpoint_queries = list(self.endpoint_queries.select_related("query").all())
+        for endpoint_query in self._endpoint_queries:
+            compile_query(endpoint_query.query)
+        self._required_groups = frozenset(self.get_required_permissions())
+
+    def get_endpoint_queries(self):
+        try:
+            return self._endpoint_queries
+        except AttributeError:
+            return list(self.endpoint_queries.select_related("query").all())
+
+    def get_queries(self):
+        return [endpoint_query.query for endpoint_query in self.get_endpoint_queries()]
+
+    def get_keys(self):
+        return [endpoint_query.key for endpoint_query in self.get_endpoint_queries()]
+
+    def _query_runs(self, params, stream, result_format, executions, keys=None):
+        endpoint_queries = self.get_endpoint_queries()
+        if keys is not None:
+            endpoint_queries = [endpoint_query for endpoint_query in endpoint_queries
+                                if endpoint_query.key in keys]
+        run_executions = [Execution(endpoint=self.url, key=endpoint_query.key,
+                                    query=endpoint_query.query)
+                          for endpoint_query in endpoint_queries]
+        if executions is not None:
+            executions.extend(run_executions)
+        ## Streamed results can only be consumed once,
+        ## so they can't be shared between keys.
+        runs = [(None if stream else endpoint_query.run_key(result_format),
+                 partial(endpoint_query.run, params=params, stream=stream,
+                         result_format=result_format, execution=execution),
+                 execution)
+                for endpoint_query, execution in zip(endpoint_queries, run_executions)]
+        return [endpoint_query.key for endpoint_query in endpoint_queries], runs
+
+    def _collect(self, keys, outputs):
         queries = {}
         results = {}
-        for endpoint_query in self.endpoint_queries.select_related("query").all():
-            sql, result = endpoint_query.run(params=params)
-            results[endpoint_query.key] = result
-            queries[endpoint_query.key] = sql
+        for key, (sql, result) in zip(keys, outputs):
+            results[key] = result
+            queries[key] = sql
         return dict(queries=queries, results=results)
 
+    def run(self, params={}, stream=False, result_format=None, executions=None,
+            keys=None):
+        keys, runs = self._query_runs(params, stream, result_format, executions, keys)
+        ## Streamed results hold their cursor open after run() returns,
+        ## so they must stay on this thread's connections.
+        outputs = run_deduplicated(
+            runs, concurrent=use_concurrency(self.concurrent_queries) and not stream)
+        return self._collect(keys, outputs)
+
+    def submit(self, params={}, result_format=None, executions=None, keys=None):
+        """
+        Runs the endpoint's queries on the query thread pool, returning a
+        concurrent.futures.Future of what run() would return, without
+        blocking the calling thread.  From asyncio code, await
+        asyncio.wrap_future(endpoint.submit(params)).
+        """
+        keys, runs = self._query_runs(params, False, result_format, executions, keys)
+        return submit_deduplicated(runs, then=partial(self._collect, keys))
+
     def get_required_permissions(self):
         return self.required_permissions.select_related("group").all().values_list(
             "group__name", flat=True)
 
+    def get_required_groups(self):
+        try:
+            return self._required_groups
+        except AttributeError:
+            return frozenset(self.get_required_permissions())
+
 class EndpointPermission(models.Model):
     endpoint = models.ForeignKey(Endpoint, related_name="required_permissions")
     group = models.ForeignKey("auth.Group")
@@ -82,28 +218,100 @@ class EndpointQuery(models.Model):
 
     cache_timeout_seconds = models.IntegerField(null=True, blank=True, default=None)
 
+    result_format = models.CharField(
+        max_length=15, choices=RESULT_FORMATS, default="dicts",
+        help_text=("The shape of the result; may be overridden per request "
+                   "with the format parameter.  Ignored with return_one "
+                   "or return_list."))
+
+    page_size = models.IntegerField(
+        null=True, blank=True, default=None,
+        help_text=("Return at most this many rows at a time, with the "
+                   "parameters for the next page.  Pages are chosen with the "
+                   "page parameter, or with after when order_by is set."))
+    order_by = models.CharField(
+        max_length=250, null=True, blank=True,
+        help_text=("A column of the query's result to order pages by; the "
+                   "next page is the rows whose value is greater than the "
+                   "after parameter."))
+
+    watermark_column = models.CharField(
+        max_length=250, null=True, blank=True,
+        help_text=("A column of the query's result whose values only ever "
+                   "increase.  When set, the since parameter returns only "
+                   "rows whose value is greater than it, and a cached "
+                   "result is refreshed by fetching only the new rows.  "
+                   "Ignored with return_one, return_list or a page_size."))
+    max_cached_rows = models.IntegerField(
+        null=True, blank=True, default=None,
+        help_text=("Keep at most this many of the newest rows in an "
+                   "incrementally refreshed result."))
+
     def __unicode__(self):
         return "'%s' as '%s' for %s" % (self.query, self.key, self.endpoint)
 
     class Meta:
         unique_together = (("query", "endpoint", "key"),)
 
-    def run(self, params={}):
+    def run_key(self, result_format=None):
+        """
+        Returns a key which is equal for endpoint queries which
+        return the same result for the same parameters.
+        """
+        return (self.query_id, self.return_one, self.return_list,
+                result_format or self.result_format, self.page_size,
+                self.order_by, self.cache_timeout_seconds,
+                self.watermark_column, self.max_cached_rows)
+
+    def is_incremental(self):
+        "Returns whether the result is ordered and refreshed by its watermark"
+        return bool(self.watermark_column and not self.page_size
+                    and not self.return_one and not self.return_list)
+
+    def run(self, params={}, stream=False, result_format=None, execution=None):
+        result_format = result_format or self.result_format
+        page = Page.from_params(self.page_size, self.order_by, params)
+        incremental = self.is_incremental()
+        since = (params.get("since") or None) if incremental else None
+        run = partial(self.query.run, return_one=self.return_one,
+                      return_list=self.return_list, params=params,
+                      result_format=result_format, page=page, execution=execution)
         if self.cache_timeout_seconds is None:
-            return self.query.run(return_one=self.return_one, return_list=self.return_list,
-                                  params=params)
+            return run(stream=stream, delta=(Delta(self.watermark_column, since)
+                                             if incremental else None))
 
         cache_name = getattr(settings, 'APIHANGAR_CACHE', "default")
         cache = caches[cache_name]
-        args = md5_constructor(json_dumps(params)).hexdigest()
-        cache_key = "apihangar.endpoint_query.%s.%s" % (self.id, args)
-        result = cache.get(cache_key)
-        if result is not None:
-            return result
-
-        result = self.query.run(return_one=self.return_one, return_list=self.return_list,
-                                params=params)
-        cache.set(cache_key, result, self.cache_timeout_seconds)
+        cache_key = result_cache_key(
+            self.query, params, return_one=self.return_one,
+            return_list=self.return_list, result_format=result_format, page=page,
+            incremental=((self.watermark_column, self.max_cached_rows)
+                         if incremental else None))
+        if execution is None:
+            execution = Execution(query=self.query)
+            run = partial(run, execution=execution)
+        execution.cache = "miss"
+
+        ## A streamed result can't be stored, so it bypasses the cache.
+        if stream:
+            result = get_cached(cache, cache_key) if since is None else None
+            if result is None:
+                return run(stream=stream, delta=(Delta(self.watermark_column, since)
+                                                 if incremental else None))
+        elif incremental:
+            result = cached_call(cache, cache_key, self.cache_timeout_seconds,
+                                 partial(refresh_incremental, run, cache, cache_key,
+                                         self.watermark_column, self.max_cached_rows))
+            if since is not None:
+                result = rows_since(result, run, cache, cache_key,
+                                    self.watermark_column, since)
+        else:
+            result = cached_call(cache, cache_key, self.cache_timeout_seconds, run)
+        ## The query finishes the execution if it ran; otherwise
+        ## the result came from the cache.
+        if not execution.finished:
+            execution.cache = "hit"
+            execution.finish()
         return result
 
 class PrebuiltView(models.Model):
@@ -113,12 +321,48 @@ class PrebuiltView(models.Model):
     template = models.CharField(max_length=250, null=True, blank=True)
     params = models.TextField(null=True, blank=True)
 
+    refresh_seconds = models.IntegerField(
+        null=True, blank=True, default=None,
+        help_text=("Serve this view from a copy of its results which the "
+                   "apihangar_warm_views command refreshes every this many "
+                   "seconds.  Leave unset to run the endpoint on every "
+                   "request."))
+
     def load_params(self):
         try:
             return json_loads(self.params)
-        except (KeyError, ValueError):
+        except (KeyError, ValueError, TypeError):
             return {}
-    
+
+    def prefetch(self):
+        """
+        Loads this view's endpoint (see Endpoint.prefetch) and its
+        required permissions.
+        """
+        self.endpoint.prefetch()
+        self._required_groups = frozenset(self.get_required_permissions())
+
+    def get_required_permissions(self):
+        return self.required_permissions.select_related("group").all().values_list(
+            "group__name", flat=True)
+
+    def get_required_groups(self):
+        try:
+            return self._required_groups
+        except AttributeError:
+            return frozenset(self.get_required_permissions())
+
 class PrebuiltViewPermission(models.Model):
     view = models.ForeignKey(PrebuiltView, related_name="required_permissions")
     group = models.ForeignKey("auth.Group")
+
+def invalidate_endpoint_metadata(sender, **kwargs):
+    from apihangar.metadata import invalidate_metadata
+    invalidate_metadata()
+
+for model in (Query, Endpoint, EndpointQuery, EndpointPermission,
+              PrebuiltView, PrebuiltViewPermission):
+    post_save.connect(invalidate_endpoint_metadata, sender=model)
+    post_delete.connect(invalidate_endpoint_metadata, sender=model)
+
+query_executed.connect(record_query_stats, dispatch_uid="apihangar.querystats")
@@ -0,0 +1,107 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from django.conf import settings
+from django.db import close_old_connections
+import threading
+
+__all__ = ["get_executor", "use_concurrency", "run_all", "submit", "gather"]
+
+_executor = None
+_executor_lock = threading.Lock()
+_worker = threading.local()
+
+def get_executor():
+    """
+    Returns the process-wide pool of threads which queries are run in,
+    sized by the APIHANGAR_QUERY_THREADS setting.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'APIHANGAR_QUERY_THREADS', 4))
+    return _executor
+
+def use_concurrency(configured=None):
+    """
+    Returns whether to run an endpoint's queries concurrently, given its
+    own configuration (None meaning "use the APIHANGAR_CONCURRENT_QUERIES
+    setting").
+    """
+    if configured is None:
+        return getattr(settings, 'APIHANGAR_CONCURRENT_QUERIES', False)
+    return configured
+
+def _call_in_worker(func):
+    ## Each pool thread holds its own Django connections, which are
+    ## recycled around every call just as they are around a request.
+    _worker.active = True
+    close_old_connections()
+    try:
+        return func()
+    finally:
+        close_old_connections()
+
+def in_worker():
+    return getattr(_worker, 'active', False)
+
+def run_all(calls, concurrent=False):
+    """
+    Calls each of a list of zero-argument callables and returns their
+    results in the same order.
+
+    With `concurrent`, the calls are fanned out over the thread pool.  Every
+    call is allowed to finish before the first exception (in list order)
+    is re-raised, so no query is left running when the caller gives up.
+    Calls made from inside a pool thread always run sequentially, so that
+    nested work can't deadlock waiting on its own pool.
+    """
+    if not concurrent or len(calls) < 2 or in_worker():
+        return [call() for call in calls]
+
+    executor = get_executor()
+    futures = [executor.submit(_call_in_worker, call) for call in calls]
+    wait(futures)
+    return [future.result() for future in futures]
+
+def submit(call):
+    """
+    Schedules a zero-argument callable on the thread pool, returning a
+    concurrent.futures.Future of its result.  Nothing waits on the
+    calling thread, so the future may be awaited from an asyncio event
+    loop with asyncio.wrap_future().
+    """
+    return get_executor().submit(_call_in_worker, call)
+
+def gather(futures, then=None):
+    """
+    Returns a Future of the list of the futures' results (passed through
+    `then`, if given), once all of them have finished.  Like run_all(), it
+    fails with the exception of the first failed future in list order.
+    """
+    gathered = Future()
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finish():
+        try:
+            results = [future.result() for future in futures]
+            if then is not None:
+                results = then(results)
+        except Exception as e:
+            gathered.set_exception(e)
+        else:
+            gathered.set_result(results)
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            finish()
+
+    if not futures:
+        finish()
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
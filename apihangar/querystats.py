@@ -0,0 +1,148 @@
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+import atexit
+import threading
+import time
+
+from apihangar.governor import acquire, release
+from apihangar.parallel import submit
+
+__all__ = ["record_query_stats", "flush_query_stats", "explain"]
+
+_lock = threading.Lock()
+_pending = {}
+_timer = [None]
+_last_explained = {}
+
+def _enabled():
+    return getattr(settings, 'APIHANGAR_QUERY_STATS', True)
+
+def record_query_stats(sender, execution, **kwargs):
+    """
+    Receives query_executed, adding each execution of a stored Query
+    against the database to its totals.  The totals are written to its
+    QueryStats, in the background, APIHANGAR_QUERY_STATS_FLUSH_SECONDS
+    (default 60) after the first execution that isn't yet written, and
+    when the process exits.
+    Executions slower than APIHANGAR_EXPLAIN_SECONDS have their plan
+    captured, at most once per query per flush interval.
+    """
+    from apihangar.models import Query
+    query = execution.query
+    if (not isinstance(query, Query) or query.pk is None
+            or execution.cache in ("hit", "coalesced") or not _enabled()):
+        return
+    pk = query.pk
+
+    seconds = execution.db_time + execution.fetch_time
+    interval = getattr(settings, 'APIHANGAR_QUERY_STATS_FLUSH_SECONDS', 60)
+    now = time.time()
+    with _lock:
+        ## A timer started before the process forked won't run in it.
+        flush_due = _timer[0] is None or not _timer[0].is_alive()
+        totals = _pending.setdefault(pk, {"calls": 0, "errors": 0, "rows": 0,
+                                          "total_time": 0.0, "max_time": 0.0})
+        totals["calls"] += 1
+        totals["errors"] += execution.error is not None
+        totals["rows"] += execution.rows or 0
+        totals["total_time"] += seconds
+        totals["max_time"] = max(totals["max_time"], seconds)
+
+        threshold = getattr(settings, 'APIHANGAR_EXPLAIN_SECONDS', None)
+        explain_due = (threshold is not None and seconds >= threshold
+                       and execution.error is None and execution.statement
+                       and now - _last_explained.get(pk, 0) >= interval)
+        if explain_due:
+            _last_explained[pk] = now
+        if flush_due:
+            _timer[0] = threading.Timer(interval, _flush_later)
+            _timer[0].daemon = True
+            _timer[0].start()
+
+    if explain_due:
+        submit(lambda: _capture_explain(pk, execution, seconds))
+
+def _flush_later():
+    with _lock:
+        _timer[0] = None
+    ## Write the totals from the query thread pool, so that
+    ## no request waits on the primary database for them.
+    submit(flush_query_stats)
+
+def _add_totals(pk, totals):
+    ## Add to the stored totals in the database, rather than
+    ## overwriting them, since every process keeps its own.
+    from apihangar.models import QueryStats
+    stats = QueryStats.objects.filter(query_id=pk)
+    added = lambda: stats.update(
+        calls=F("calls") + totals["calls"],
+        errors=F("errors") + totals["errors"],
+        rows=F("rows") + totals["rows"],
+        total_time=F("total_time") + totals["total_time"],
+        max_time=Greatest(F("max_time"), totals["max_time"]))
+    if added():
+        return
+    try:
+        with transaction.atomic(using=stats.db):
+            QueryStats.objects.create(query_id=pk, **totals)
+    except IntegrityError:
+        ## Another process created them first.
+        added()
+
+def flush_query_stats():
+    "Writes the totals gathered in this process to their QueryStats"
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+    for pk, totals in pending.items():
+        try:
+            _add_totals(pk, totals)
+        except DatabaseError:
+            ## The query was deleted, or the database is unavailable;
+            ## statistics aren't worth failing a request for.
+            pass
+
+atexit.register(flush_query_stats)
+
+_explain_prefixes = {
+    "postgresql": "EXPLAIN",
+    "mysql": "EXPLAIN",
+    "sqlite": "EXPLAIN QUERY PLAN",
+    }
+
+def explain(alias, statement, args=None):
+    """
+    Returns the database's plan for the statement as text, or None
+    if the database isn't one whose EXPLAIN is supported.
+    """
+    connection = connections[alias]
+    prefix = _explain_prefixes.get(connection.vendor)
+    if prefix is None:
+        return None
+    token = acquire(alias)
+    try:
+        with connection.cursor() as cursor:
+            if args is None:
+                cursor.execute("%s %s" % (prefix, statement))
+            else:
+                cursor.execute("%s %s" % (prefix, statement), args)
+            return "\n".join(" ".join("%s" % value for value in row)
+                             for row in cursor.fetchall())
+    finally:
+        release(token)
+
+def _capture_explain(pk, execution, seconds):
+    from apihangar.models import QueryStats
+    try:
+        plan = explain(execution.database, execution.statement, execution.args)
+        if plan is None:
+            return
+        QueryStats.objects.get_or_create(query_id=pk)
+        QueryStats.objects.filter(query_id=pk).update(
+            explain=plan, explain_sql=execution.sql, explain_time=seconds,
+            explained_at=timezone.now())
+    except DatabaseError:
+        pass
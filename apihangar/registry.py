@@ -1,14 +1,29 @@
 
-from apihangar.core import get_variables, render_sql, run
+from apihangar.core import get_variables, render_sql, run, Delta, Page
+from apihangar.instrumentation import Execution
+from apihangar.parallel import use_concurrency
+from apihangar.singleflight import run_deduplicated, submit_deduplicated
+from functools import partial
 
 class Query(object):
     def __init__(self, sql, database, 
                  use_templates=False, 
                  return_one=False, return_list=False,
-                 cache_timeout_seconds=None):
+                 cache_timeout_seconds=None,
+                 use_bind_params=False,
+                 result_format="dicts",
+                 page_size=None, order_by=None,
+                 timeout_seconds=None, max_rows=None, watermark_column=None):
         self.sql = sql
         self.database = database
         self.use_templates = use_templates
+        self.use_bind_params = use_bind_params
+        self.result_format = result_format
+        self.page_size = page_size
+        self.order_by = order_by
+        self.timeout_seconds = timeout_seconds
+        self.max_rows = max_rows
+        self.watermark_column = watermark_column
         self.return_one = return_one
         self.return_list = return_list
         self.cache_timeout_seconds = cache_timeout_seconds
@@ -19,33 +34,85 @@ class Query(object):
     def render_sql(self, params):
         return render_sql(self, params)
     
-    def run(self, params={}):
+    def run_key(self, result_format=None):
+        return (self.database, self.sql, self.use_templates, self.use_bind_params,
+                self.return_one, self.return_list, result_format or self.result_format,
+                self.page_size, self.order_by, self.timeout_seconds, self.max_rows,
+                self.watermark_column)
+
+    def run(self, params={}, stream=False, result_format=None, execution=None):
+        delta = None
+        if (self.watermark_column and not self.page_size
+                and not self.return_one and not self.return_list):
+            delta = Delta(self.watermark_column, params.get("since") or None)
         return run(self, return_one=self.return_one, return_list=self.return_list,
-                   params=params)
+                   params=params, stream=stream,
+                   result_format=result_format or self.result_format,
+                   page=Page.from_params(self.page_size, self.order_by, params),
+                   execution=execution, delta=delta)
 
 class Endpoint(object):
 
-    def __init__(self, name, description, url, queries={}, permissions=[]):
+    def __init__(self, name, description, url, queries={}, permissions=[],
+                 concurrent_queries=None, response_cache_seconds=None):
         self.name = name
         self.description = description
         self.url = url
         self.queries = queries
         self.permissions = permissions
+        self.concurrent_queries = concurrent_queries
+        self.response_cache_seconds = response_cache_seconds
+
+    def get_keys(self):
+        return list(self.queries.keys())
 
-    def run(self, params={}):
+    def _query_runs(self, params, stream, result_format, executions, keys=None):
+        items = [(key, query) for key, query in self.queries.items()
+                 if keys is None or key in keys]
+        run_executions = [Execution(endpoint=self.url, key=key, query=query)
+                          for key, query in items]
+        if executions is not None:
+            executions.extend(run_executions)
+        runs = [(None if stream else query.run_key(result_format),
+                 partial(query.run, params=params, stream=stream,
+                         result_format=result_format, execution=execution),
+                 execution)
+                for (key, query), execution in zip(items, run_executions)]
+        return [key for key, query in items], runs
+
+    def _collect(self, keys, outputs):
         queries = {}
         results = {}
-        for key, query in self.queries.items():
-            sql, result = query.run(params=params)
+        for key, (sql, result) in zip(keys, outputs):
             results[key] = result
             queries[key] = sql
         return dict(queries=queries, results=results)
 
+    def run(self, params={}, stream=False, result_format=None, executions=None,
+            keys=None):
+        keys, runs = self._query_runs(params, stream, result_format, executions, keys)
+        outputs = run_deduplicated(
+            runs, concurrent=use_concurrency(self.concurrent_queries) and not stream)
+        return self._collect(keys, outputs)
+
+    def submit(self, params={}, result_format=None, executions=None, keys=None):
+        keys, runs = self._query_runs(params, False, result_format, executions, keys)
+        return submit_deduplicated(runs, then=partial(self._collect, keys))
+
+    def get_queries(self):
+        return list(self.queries.values())
+
     def get_required_permissions(self):
         return self.permissions
 
+    def get_required_groups(self):
+        return frozenset(self.permissions)
+
 registry = {}
 
-def register_endpoint(url, name, description, queries, permissions=[]):
-    registry[url] = Endpoint(name, description, url, queries=queries, permissions=permissions)
+def register_endpoint(url, name, description, queries, permissions=[],
+                      concurrent_queries=None, response_cache_seconds=None):
+    registry[url] = Endpoint(name, description, url, queries=queries, permissions=permissions,
+                             concurrent_queries=concurrent_queries,
+                             response_cache_seconds=response_cache_seconds)
 
@@ -3,4 +3,33 @@ required = [
     ]
 optional = [
     "APIHANGAR_CACHE",
+    "APIHANGAR_CACHE_JITTER",
+    "APIHANGAR_CACHE_LOCK_SECONDS",
+    "APIHANGAR_CACHE_STALE_SECONDS",
+    "APIHANGAR_COALESCE_QUERIES",
+    "APIHANGAR_COMPILED_QUERY_CACHE_SIZE",
+    "APIHANGAR_DATABASE_POOLS",
+    "APIHANGAR_EXPLAIN_SECONDS",
+    "APIHANGAR_INCREMENTAL_SECONDS",
+    "APIHANGAR_JSON_BACKEND",
+    "APIHANGAR_LOCAL_CACHE_BYTES",
+    "APIHANGAR_LOCAL_CACHE_CHECK_SECONDS",
+    "APIHANGAR_MAX_BATCH_ITEMS",
+    "APIHANGAR_MAX_CONCURRENT_QUERIES",
+    "APIHANGAR_MAX_QUEUED_QUERIES",
+    "APIHANGAR_MAX_ROWS",
+    "APIHANGAR_METADATA_CACHE",
+    "APIHANGAR_METRICS_SAMPLES",
+    "APIHANGAR_PERMISSION_CACHE_SECONDS",
+    "APIHANGAR_POOL_EJECT_ERRORS",
+    "APIHANGAR_POOL_EJECT_SECONDS",
+    "APIHANGAR_POOL_POLICY",
+    "APIHANGAR_CONCURRENT_QUERIES",
+    "APIHANGAR_QUERY_QUEUE_SECONDS",
+    "APIHANGAR_QUERY_STATS",
+    "APIHANGAR_QUERY_STATS_FLUSH_SECONDS",
+    "APIHANGAR_QUERY_THREADS",
+    "APIHANGAR_SERVER_TIMING",
+    "APIHANGAR_STATEMENT_TIMEOUTS",
+    "APIHANGAR_STREAM_CHUNK_SIZE",
     ]
@@ -0,0 +1,178 @@
+from django.conf import settings
+from django.db import InterfaceError, OperationalError
+import random
+import threading
+import time
+
+__all__ = ["POLICIES", "Pool", "Lease", "get_pool", "route", "pool_status"]
+
+POLICIES = ("round_robin", "least_in_flight", "latency")
+
+class _Member(object):
+    "One database alias in a pool, and what is known of its health"
+    def __init__(self, alias):
+        self.alias = alias
+        self.in_flight = 0
+        self.latency = None
+        self.errors = 0
+        self.ejected_until = 0
+
+    def healthy(self, now):
+        return self.ejected_until <= now
+
+class Pool(object):
+    """
+    Several database aliases serving the same data, one of which is
+    chosen for each query by the pool's policy: "round_robin",
+    "least_in_flight" (the alias running the fewest queries from this
+    process), or "latency" (a random alias, weighted towards those which
+    have recently answered fastest).
+
+    An alias is ejected from the pool for APIHANGAR_POOL_EJECT_SECONDS
+    (default 30) after APIHANGAR_POOL_EJECT_ERRORS (default 3) queries in
+    a row fail with connection errors or timeouts.  If every alias has
+    been ejected, the one due back soonest is used anyway.
+    """
+    def __init__(self, name, aliases, policy="round_robin"):
+        if policy not in POLICIES:
+            raise ValueError("Unknown pool policy %r for %s" % (policy, name))
+        self.name = name
+        self.aliases = tuple(aliases)
+        self.policy = policy
+        self.members = [_Member(alias) for alias in self.aliases]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _choose(self, now):
+        candidates = [member for member in self.members if member.healthy(now)]
+        if not candidates:
+            return min(self.members, key=lambda member: member.ejected_until)
+        if self.policy == "latency":
+            known = [member.latency for member in candidates if member.latency]
+            ## Aliases not yet measured are treated as the fastest, so
+            ## that they get tried.
+            fastest = min(known) if known else 1.0
+            weights = [1.0 / (member.latency or fastest) for member in candidates]
+            point = random.random() * sum(weights)
+            for member, weight in zip(candidates, weights):
+                point -= weight
+                if point <= 0:
+                    return member
+            return candidates[-1]
+        self._next += 1
+        offset = self._next % len(candidates)
+        candidates = candidates[offset:] + candidates[:offset]
+        if self.policy == "least_in_flight":
+            return min(candidates, key=lambda member: member.in_flight)
+        return candidates[0]
+
+    def lease(self):
+        "Chooses an alias, returning a Lease of it for one query"
+        with self._lock:
+            member = self._choose(time.time())
+            member.in_flight += 1
+        return Lease(self, member)
+
+    def _succeeded(self, member, seconds):
+        with self._lock:
+            member.errors = 0
+            if member.latency is None:
+                member.latency = seconds
+            else:
+                member.latency = 0.7 * member.latency + 0.3 * seconds
+
+    def _failed(self, member):
+        with self._lock:
+            member.errors += 1
+            if member.errors >= getattr(settings, 'APIHANGAR_POOL_EJECT_ERRORS', 3):
+                member.errors = 0
+                member.ejected_until = (
+                    time.time() + getattr(settings, 'APIHANGAR_POOL_EJECT_SECONDS', 30))
+
+    def _release(self, member):
+        with self._lock:
+            member.in_flight -= 1
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "aliases": [{
+                    "alias": member.alias,
+                    "in_flight": member.in_flight,
+                    "latency": member.latency,
+                    "healthy": member.healthy(now),
+                    } for member in self.members],
+                }
+
+class Lease(object):
+    """
+    The alias a query runs on.  Report how executing the query went with
+    succeeded() or failed(), and call release() once it has finished.
+    """
+    def __init__(self, pool, member=None, alias=None):
+        self.pool = pool
+        self.member = member
+        self.alias = member.alias if member is not None else alias
+        self.released = False
+
+    def succeeded(self, seconds):
+        if self.pool is not None:
+            self.pool._succeeded(self.member, seconds)
+
+    def failed(self, error):
+        ## Only errors which say something about the database's
+        ## health count against it, not errors in the query.
+        if self.pool is not None and isinstance(error, (OperationalError, InterfaceError)):
+            self.pool._failed(self.member)
+
+    def release(self):
+        if self.pool is not None and not self.released:
+            self.released = True
+            self.pool._release(self.member)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _pool_config(name):
+    ## Pools are given as a list of aliases, or as a dict
+    ## of their "aliases" and their "policy".
+    config = getattr(settings, 'APIHANGAR_DATABASE_POOLS', {}).get(name)
+    if config is None:
+        return None
+    if isinstance(config, dict):
+        aliases = config["aliases"]
+        policy = config.get("policy")
+    else:
+        aliases, policy = config, None
+    return (tuple(aliases),
+            policy or getattr(settings, 'APIHANGAR_POOL_POLICY', "round_robin"))
+
+def get_pool(name):
+    "Returns the Pool named in APIHANGAR_DATABASE_POOLS, or None"
+    config = _pool_config(name)
+    if config is None:
+        return None
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None or (pool.aliases, pool.policy) != config:
+            pool = _pools[name] = Pool(name, *config)
+    return pool
+
+def route(database):
+    """
+    Returns a Lease of the connection alias to run a query for
+    `database` on: one of the aliases of the pool of that name, if
+    there is one, or else `database` itself.
+    """
+    pool = get_pool(database)
+    if pool is None:
+        return Lease(None, alias=database)
+    return pool.lease()
+
+def pool_status():
+    "Returns the state of every pool which has been used, by name"
+    with _pools_lock:
+        pools = list(_pools.values())
+    return dict((pool.name, pool.status()) for pool in pools)
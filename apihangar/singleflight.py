@@ -0,0 +1,100 @@
+from django.conf import settings
+import threading
+
+from apihangar.parallel import gather, run_all, submit
+
+__all__ = ["SingleFlight", "coalescing", "run_deduplicated", "submit_deduplicated"]
+
+def coalescing():
+    "Returns whether identical queries should share one execution"
+    return getattr(settings, 'APIHANGAR_COALESCE_QUERIES', True)
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight(object):
+    """
+    Lets concurrent identical calls share a single execution: while a
+    call for a key is in flight, further calls for the same key wait for
+    it and are given its result (or its exception) instead of calling
+    again.  Nothing is kept once the call has finished.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, func):
+        """
+        Returns a pair of func()'s result, or that of the identical call
+        already in flight, and whether it was shared with such a call.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        try:
+            flight.value = func()
+            return flight.value, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+def _leaders(runs):
+    ## The position of the first run with each run's key.
+    if not coalescing():
+        return list(range(len(runs)))
+    first = {}
+    return [i if key is None else first.setdefault(key, i)
+            for i, (key, call, execution) in enumerate(runs)]
+
+def _spread(runs, leaders, outputs):
+    ## Gives each run the output of its leader, finishing the
+    ## executions of the runs which weren't made.
+    outputs = dict(zip([i for i, leader in enumerate(leaders) if leader == i], outputs))
+    for i, leader in enumerate(leaders):
+        execution = runs[i][2]
+        if leader != i and execution is not None:
+            execution.coalesce(runs[leader][2])
+            execution.finish()
+    return [outputs[leader] for leader in leaders]
+
+def run_deduplicated(runs, concurrent=False):
+    """
+    Runs a list of (key, call, execution) triples as run_all() does,
+    returning the calls' results in order, except that calls with the
+    same key (other than None) are only made once.  The executions of
+    the calls which weren't made are finished as sharing the result of
+    the first one that was.
+    """
+    leaders = _leaders(runs)
+    outputs = run_all([runs[i][1] for i, leader in enumerate(leaders) if leader == i],
+                      concurrent)
+    return _spread(runs, leaders, outputs)
+
+def submit_deduplicated(runs, then=None):
+    """
+    Like run_deduplicated(), but submits the calls to the thread pool and
+    returns a Future of their results (passed through `then`, if given)
+    instead of waiting for them.
+    """
+    leaders = _leaders(runs)
+    futures = [submit(runs[i][1]) for i, leader in enumerate(leaders) if leader == i]
+    def spread(outputs):
+        outputs = _spread(runs, leaders, outputs)
+        return outputs if then is None else then(outputs)
+    return gather(futures, then=spread)
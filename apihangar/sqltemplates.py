@@ -0,0 +1,102 @@
+from django.template import Context, Template
+from django.template.base import FilterExpression, Variable
+from django.template.defaulttags import ForNode, WithNode
+
+__all__ = ["SQLTemplate", "template_variables"]
+
+_engine = None
+
+def _project_engine():
+    from django.template import engines
+    from django.template.backends.django import DjangoTemplates
+    for backend in engines.all():
+        if isinstance(backend, DjangoTemplates):
+            return backend.engine
+    return None
+
+def _get_engine():
+    ## A private engine, so that the project's autoescaping doesn't
+    ## apply to SQL; it shares the project's tag libraries, so that
+    ## queries can still {% load %} them.
+    global _engine
+    if _engine is None:
+        from django.template import Engine
+        project = _project_engine()
+        options = {}
+        if project is not None:
+            options["libraries"] = project.libraries
+            options["builtins"] = [builtin for builtin in project.builtins
+                                   if builtin not in Engine.default_builtins]
+        try:
+            _engine = Engine(autoescape=False, **options)
+        except TypeError:
+            ## Django < 1.10; contexts without autoescape suffice.
+            _engine = Engine(**options)
+    return _engine
+
+class SQLTemplate(object):
+    """
+    SQL written in Django template syntax, which is compiled once and
+    rendered without escaping any values.  Rendering changes no shared
+    state, so one SQLTemplate can be rendered by many threads at once.
+    """
+    def __init__(self, source):
+        self.template = Template(source, engine=_get_engine())
+        self.variables = template_variables(self.template)
+
+    def render(self, params):
+        return self.template.render(Context(params, autoescape=False))
+
+## Node attributes which refer to the template's source
+## rather than to anything rendered.
+_skipped_attributes = ("origin", "token", "source")
+
+def _variable_name(value):
+    if isinstance(value, Variable) and value.lookups is not None:
+        return value.var
+    return None
+
+def _collect(value, found, bound, seen):
+    if id(value) in seen:
+        return
+    seen.add(id(value))
+    if isinstance(value, FilterExpression):
+        names = [_variable_name(value.var)]
+        for func, args in value.filters:
+            names.extend(_variable_name(arg) for lookup, arg in args if lookup)
+        for name in names:
+            if (name is not None and name.split(".")[0] not in bound
+                    and name not in found):
+                found.append(name)
+        return
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            _collect(item, found, bound, seen)
+        return
+    if isinstance(value, dict):
+        for key in sorted(value, key=str):
+            _collect(value[key], found, bound, seen)
+        return
+    if not type(value).__module__.startswith("django.template"):
+        return
+
+    ## Names bound by the template itself aren't variables of the query.
+    if isinstance(value, ForNode):
+        _collect(value.sequence, found, bound, seen)
+        bound = bound | set(value.loopvars) | set(["forloop"])
+    elif isinstance(value, WithNode):
+        _collect(value.extra_context, found, bound, seen)
+        bound = bound | set(value.extra_context)
+    for name, item in sorted(vars(value).items()):
+        if name not in _skipped_attributes:
+            _collect(item, found, bound, seen)
+
+def template_variables(template):
+    """
+    Returns the names of the variables used anywhere in a compiled
+    Template, in every branch, in the order they are found, by walking
+    its nodes rather than rendering it.
+    """
+    found = []
+    _collect(template.nodelist, found, frozenset(), set())
+    return found
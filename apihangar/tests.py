@@ -0,0 +1,123 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase, override_settings
+import threading
+import time
+
+from apihangar.caching import cached_call, get_cached
+from apihangar.core import result_cache_key
+from apihangar.governor import acquire, release
+from apihangar.registry import Query
+from apihangar.singleflight import SingleFlight
+from apihangar.views import governed
+
+class ResultCacheKeyTests(SimpleTestCase):
+    def test_attribute_lookups_key_on_the_parameter(self):
+        query = Query("SELECT * FROM ev WHERE id = {{ int:ids.0 }}", "default",
+                      use_templates=True)
+        self.assertNotEqual(result_cache_key(query, {"ids": (1,)}),
+                            result_cache_key(query, {"ids": (2,)}))
+
+    def test_unused_parameters_share_a_key(self):
+        query = Query("SELECT * FROM ev WHERE id = %(id)d", "default")
+        self.assertEqual(query.get_variables(), ["int:id"])
+        self.assertEqual(result_cache_key(query, {"id": 1, "other": "a"}),
+                         result_cache_key(query, {"id": 1, "other": "b"}))
+        self.assertNotEqual(result_cache_key(query, {"id": 1}),
+                            result_cache_key(query, {"id": 2}))
+
+def _in_threads(count, func):
+    ## Calls func() in `count` threads at once, returning their results.
+    results = [None] * count
+    def call(i):
+        results[i] = func()
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+class CachedCallTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = LocMemCache(self.id(), {})
+        self.calls = []
+
+    def compute(self, value, wait=None, error=None):
+        def compute():
+            self.calls.append(value)
+            if wait is not None:
+                wait.wait(5)
+            if error is not None:
+                raise error
+            return value
+        return compute
+
+    def test_one_caller_recomputes(self):
+        done = threading.Event()
+        threading.Timer(0.2, done.set).start()
+        results = _in_threads(8, lambda: cached_call(self.cache, "key", 60,
+                                                     self.compute("new", done)))
+        self.assertEqual(results, ["new"] * 8)
+        self.assertEqual(self.calls, ["new"])
+
+    @override_settings(APIHANGAR_CACHE_STALE_SECONDS=60)
+    def test_stale_value_served_while_locked(self):
+        cached_call(self.cache, "key", 0, self.compute("old"))
+        done = threading.Event()
+        leader = threading.Thread(target=cached_call, args=(
+            self.cache, "key", 60, self.compute("new", done)))
+        leader.start()
+        while len(self.calls) < 2:
+            time.sleep(0.01)
+        self.assertEqual(cached_call(self.cache, "key", 60, self.compute("other")), "old")
+        done.set()
+        leader.join()
+        self.assertEqual(self.calls, ["old", "new"])
+        self.assertEqual(get_cached(self.cache, "key"), "new")
+
+    @override_settings(APIHANGAR_CACHE_LOCK_SECONDS=5)
+    def test_waiter_takes_over_when_holder_fails(self):
+        fail, errors = threading.Event(), []
+        def leader():
+            try:
+                cached_call(self.cache, "key", 60,
+                            self.compute("failed", fail, ValueError()))
+            except ValueError as e:
+                errors.append(e)
+        thread = threading.Thread(target=leader)
+        thread.start()
+        while not self.calls:
+            time.sleep(0.01)
+        threading.Timer(0.2, fail.set).start()
+        started = time.time()
+        self.assertEqual(cached_call(self.cache, "key", 60, self.compute("new")), "new")
+        ## Well before the lock would have expired.
+        self.assertLess(time.time() - started, 2)
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.calls, ["failed", "new"])
+
+class SingleFlightTests(SimpleTestCase):
+    def test_identical_calls_share_one_execution(self):
+        flights, calls, done = SingleFlight(), [], threading.Event()
+        threading.Timer(0.2, done.set).start()
+        def func():
+            calls.append(1)
+            done.wait(5)
+            return "value"
+        results = _in_threads(8, lambda: flights.do("key", func))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [("value", False)] + [("value", True)] * 7)
+
+@override_settings(APIHANGAR_MAX_CONCURRENT_QUERIES={"tests": 1},
+                   APIHANGAR_MAX_QUEUED_QUERIES={"tests": 0})
+class GovernorTests(SimpleTestCase):
+    def test_full_queue_is_rejected(self):
+        token = acquire("tests")
+        try:
+            view = governed(lambda request: release(acquire("tests")))
+            response, = _in_threads(1, lambda: view(None))
+        finally:
+            release(token)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
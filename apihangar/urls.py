@@ -15,7 +15,21 @@ urlpatterns = [
         {'response_type': "html"},
         name='execute_endpoint_html'),
 
+    url(r'^csv/(?P<api_url>.*)/$', apihangar.views.execute_endpoint,
+        {'response_type': "csv"},
+        name='execute_endpoint_csv'),
+    url(r'^ndjson/(?P<api_url>.*)/$', apihangar.views.execute_endpoint,
+        {'response_type': "ndjson"},
+        name='execute_endpoint_ndjson'),
+    url(r'^arrow/(?P<api_url>.*)/$', apihangar.views.execute_endpoint,
+        {'response_type': "arrow"},
+        name='execute_endpoint_arrow'),
+
     url('^view/(?P<view_url>.*)/$', apihangar.views.execute_view, 
         name='execute_view'),
+
+    url(r'^batch/$', apihangar.views.execute_batch, name='execute_batch'),
+
+    url(r'^metrics/$', apihangar.views.query_metrics, name='query_metrics'),
     
 ]
@@ -18,42 +18,352 @@ if sys.version_info[:2] < (2, 7):
 else:
     import json
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.core.serializers.json import DjangoJSONEncoder
 from collections import OrderedDict as SortedDict
+import threading
+import time
 
-def dictfetchall(cursor):
+from apihangar.governor import RowLimitExceeded
+
+def fetchall(cursor, max_rows=None):
+    """
+    Returns all rows from a cursor, raising RowLimitExceeded as soon as
+    there turn out to be more than `max_rows` of them.
+    """
+    if max_rows is None:
+        return cursor.fetchall()
+    rows = cursor.fetchmany(max_rows + 1)
+    if len(rows) > max_rows:
+        raise RowLimitExceeded("Query returned more than %d rows" % max_rows)
+    return rows
+
+def dictfetchall(cursor, max_rows=None):
     "Returns all rows from a cursor as a dict"
     desc = cursor.description
     return [
         SortedDict(zip([col[0] for col in desc], row))
-        for row in cursor.fetchall()
+        for row in fetchall(cursor, max_rows)
     ]
 
+def columnfetchall(cursor, max_rows=None):
+    """
+    Returns all rows from a cursor in columnar form: a dict of the
+    column names and the list of raw row tuples.
+    """
+    return SortedDict([
+        ("columns", [col[0] for col in cursor.description]),
+        ("rows", fetchall(cursor, max_rows)),
+    ])
+
+RESULT_FORMATS = (
+    ("dicts", "A list of rows as dicts"),
+    ("columns", "A list of column names and a list of rows as lists"),
+    )
+
+class RowStream(object):
+    """
+    Iterates over a cursor's rows, fetching them in chunks of `chunk_size`
+    as they are consumed and closing the cursor once exhausted.  Rows are
+    yielded as dicts, or with `flatten`, as the individual items of each
+    row, or with `raw`, as the tuples returned by the cursor.  A RowStream
+    can only be iterated once.
+
+    RowLimitExceeded is raised once more than `max_rows` rows have been
+    fetched.  Each of the `on_close` callbacks is called, with the
+    stream, when it is exhausted or closed.  A stream which won't be
+    exhausted must be closed, to give back its cursor.
+    """
+    def __init__(self, cursor, chunk_size=1000, flatten=False, raw=False,
+                 max_rows=None, on_close=()):
+        self.cursor = cursor
+        self.chunk_size = chunk_size
+        self.flatten = flatten
+        self.raw = raw
+        self.max_rows = max_rows
+        self.on_close = list(on_close)
+        self.closed = False
+        self.fetched = 0
+
+    def chunks(self):
+        "Yields the rows (or items, with `flatten`) a chunk at a time, as lists"
+        cursor = self.cursor
+        try:
+            columns = [col[0] for col in cursor.description]
+            while True:
+                rows = cursor.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                self.fetched += len(rows)
+                if self.max_rows is not None and self.fetched > self.max_rows:
+                    raise RowLimitExceeded(
+                        "Query returned more than %d rows" % self.max_rows)
+                if self.raw:
+                    yield rows
+                elif self.flatten:
+                    yield [item for row in rows for item in row]
+                else:
+                    yield [SortedDict(zip(columns, row)) for row in rows]
+        finally:
+            self.close()
+
+    def __iter__(self):
+        for rows in self.chunks():
+            for row in rows:
+                yield row
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        ## Drop the callbacks, and whatever they hold, once called.
+        callbacks, self.on_close = self.on_close, []
+        try:
+            self.cursor.close()
+        finally:
+            for callback in callbacks:
+                callback(self)
+
+def find_streams(obj):
+    "Returns the RowStreams within a result, or dicts and lists of results"
+    if isinstance(obj, RowStream):
+        return [obj]
+    if isinstance(obj, dict):
+        obj = obj.values()
+    elif not isinstance(obj, (list, tuple)):
+        return []
+    return [stream for item in obj for stream in find_streams(item)]
+
+class ClosingIterator(object):
+    """
+    Iterates over `iterable`, and closes each of `closables` when it
+    is closed itself -- as a streaming response's content is once the
+    response has been sent, or the client has gone away.
+    """
+    def __init__(self, iterable, closables):
+        self.iterator = iter(iterable)
+        self.closables = closables
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+    next = __next__
+
+    def close(self):
+        closables, self.closables = self.closables, []
+        for closable in closables:
+            closable.close()
+
+class LRUCache(object):
+    """
+    A thread-safe mapping which holds at most `size` items,
+    evicting the least recently used item when it is full.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._data = SortedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def discard(self, predicate):
+        "Removes every item whose key matches the predicate"
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
 def sorteddict_with_tuples(pairs):
     return SortedDict((k, v) if not isinstance(v, list)
                       else (k, tuple(v))
                       for k, v in pairs)
 
-def json_dumps(*args, **kw):
-    kw.setdefault('indent', 2)
-    kw.setdefault('cls', DjangoJSONEncoder)
-    return json.dumps(*args, **kw)
+_django_encoder = DjangoJSONEncoder()
+
+def _stdlib_dumps(obj, pretty=False, sort_keys=False):
+    if pretty:
+        return json.dumps(obj, cls=DjangoJSONEncoder, indent=2, sort_keys=sort_keys)
+    return json.dumps(obj, cls=DjangoJSONEncoder, separators=(",", ":"),
+                      sort_keys=sort_keys)
+
+def _orjson_backend():
+    import orjson
+    ## Leave datetimes to DjangoJSONEncoder, which formats
+    ## them differently; Decimals fall through to it too.
+    base = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    def dumps(obj, pretty=False, sort_keys=False):
+        option = base
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=_django_encoder.default,
+                            option=option).decode("utf-8")
+    return dumps
+
+def _simplejson_backend():
+    import simplejson
+    ## simplejson's C encoder runs on Python 2 as well as 3, and writes
+    ## Decimals itself, as exact numbers; datetimes and the like are
+    ## still left to DjangoJSONEncoder.
+    def dumps(obj, pretty=False, sort_keys=False):
+        options = dict(default=_django_encoder.default, use_decimal=True,
+                       namedtuple_as_object=False, sort_keys=sort_keys)
+        if pretty:
+            return simplejson.dumps(obj, indent=2, **options)
+        return simplejson.dumps(obj, separators=(",", ":"), **options)
+    return dumps
+
+JSON_BACKENDS = {
+    "json": lambda: _stdlib_dumps,
+    "simplejson": _simplejson_backend,
+    "orjson": _orjson_backend,
+    }
+
+_json_backend = [None, None]
+
+def _get_json_backend():
+    name = getattr(settings, 'APIHANGAR_JSON_BACKEND', "json")
+    if _json_backend[0] != name:
+        if name not in JSON_BACKENDS:
+            raise ImproperlyConfigured(
+                "APIHANGAR_JSON_BACKEND must be one of %s" % ", ".join(sorted(JSON_BACKENDS)))
+        try:
+            _json_backend[:] = [name, JSON_BACKENDS[name]()]
+        except ImportError:
+            raise ImproperlyConfigured(
+                "APIHANGAR_JSON_BACKEND is %r, but it isn't installed" % name)
+    return _json_backend[1]
+
+def json_dumps(obj, pretty=False, sort_keys=False, **kw):
+    """
+    Serializes obj to JSON with the APIHANGAR_JSON_BACKEND ("json", the
+    default, "simplejson" or "orjson"), compactly or, with `pretty`,
+    indented by two spaces.  Values the backend can't serialize itself,
+    like Decimals and datetimes, are written as DjangoJSONEncoder writes
+    them.  Any other keyword arguments (like `indent` or `cls`) are
+    passed on to the standard library's json.dumps instead.
+    """
+    if kw:
+        kw.setdefault("cls", DjangoJSONEncoder)
+        kw.setdefault("sort_keys", sort_keys)
+        if pretty:
+            kw.setdefault("indent", 2)
+        elif kw.get("indent") is None:
+            kw.setdefault("separators", (",", ":"))
+        return json.dumps(obj, **kw)
+    return _get_json_backend()(obj, pretty=pretty, sort_keys=sort_keys)
+
+def _json_iterencode(obj):
+    if isinstance(obj, dict):
+        yield "{"
+        for i, (key, value) in enumerate(obj.items()):
+            yield "%s%s:" % ("," if i else "", json_dumps(key))
+            for chunk in _json_iterencode(value):
+                yield chunk
+        yield "}"
+    elif isinstance(obj, RowStream):
+        ## Rows hold no further streams, so serialize them a
+        ## chunk at a time rather than one value at a time.
+        yield "["
+        first = True
+        for rows in obj.chunks():
+            if rows:
+                yield ("" if first else ",") + json_dumps(rows)[1:-1]
+                first = False
+        yield "]"
+    elif isinstance(obj, (list, tuple)):
+        yield "["
+        for i, item in enumerate(obj):
+            if i:
+                yield ","
+            for chunk in _json_iterencode(item):
+                yield chunk
+        yield "]"
+    else:
+        yield json_dumps(obj)
+
+def json_iterdumps(obj, buffer_size=65536):
+    """
+    Serializes obj to JSON incrementally, yielding strings of roughly
+    `buffer_size` characters.  Any RowStreams within obj are consumed
+    as they are reached, so the full result never needs to be in memory.
+    """
+    buffer = []
+    length = 0
+    for chunk in _json_iterencode(obj):
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= buffer_size:
+            yield "".join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield "".join(buffer)
 
 def json_loads(*args, **kw):
     """
     Load list-like objects from JSON as Python tuples, not lists.
     """
-    kw.setdefault('object_pairs_hooks', sorteddict_with_tuples)
+    kw.setdefault('object_pairs_hook', sorteddict_with_tuples)
     return json.loads(*args, **kw)
 
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from djangohelpers.lib import rendered_with
+import itertools
 
-def render_response(request, response_type, ctx,
-                    default_template='apihangar/default_template.html'):
+def request_flag(request, name):
+    "Returns whether the named GET parameter is set to a true-ish value"
+    return request.GET.get(name, "").lower() in ("1", "true", "yes", "on")
 
-    if response_type == "json":
-        json = json_dumps(ctx)
+def request_result_format(request):
+    "Returns the result format requested with the `format` GET parameter"
+    format = request.GET.get("format")
+    if format in dict(RESULT_FORMATS):
+        return format
+    return None
+
+def render_response(request, response_type, ctx,
+                    default_template='apihangar/default_template.html',
+                    stream=False):
+    """
+    Renders ctx as the response type.  JSON is written compactly,
+    unless the request asks for it with pretty=1.
+    """
+    if response_type == "json" and stream:
+        chunks = json_iterdumps(ctx)
+        jsonp = request.GET.get("jsonp") or request.GET.get("callback")
+        if jsonp:
+            return StreamingHttpResponse(
+                itertools.chain(["%s(" % jsonp], chunks, [");"]),
+                content_type="text/javascript")
+        else:
+            return StreamingHttpResponse(chunks, content_type="application/json")
+    elif response_type == "json":
+        json = json_dumps(ctx, pretty=request_flag(request, "pretty"))
         jsonp = request.GET.get("jsonp") or request.GET.get("callback")
         if jsonp:
             return HttpResponse("%s(%s);" % (jsonp, json), 
@@ -67,8 +377,46 @@ def render_response(request, response_type, ctx,
             return ctx
         return inner(request, ctx)
 
+def get_user_groups(request):
+    """
+    Returns the set of names of the requesting user's groups.  It is
+    looked up once per request, and if APIHANGAR_PERMISSION_CACHE_SECONDS
+    is set, kept in the user's session for that many seconds.
+    """
+    try:
+        return request._apihangar_groups
+    except AttributeError:
+        pass
+
+    user = request.user
+    if not user.is_authenticated:
+        groups = frozenset()
+    else:
+        groups = None
+        timeout = getattr(settings, 'APIHANGAR_PERMISSION_CACHE_SECONDS', None)
+        session = getattr(request, "session", None) if timeout else None
+        if session is not None:
+            cached = session.get("apihangar.groups")
+            if cached and cached[0] == user.pk and cached[1] > time.time():
+                groups = frozenset(cached[2])
+        if groups is None:
+            groups = frozenset(user.groups.values_list("name", flat=True))
+            if session is not None:
+                session["apihangar.groups"] = (user.pk, time.time() + timeout,
+                                               sorted(groups))
+
+    request._apihangar_groups = groups
+    return groups
+
 def check_permission(request, object):
-    groups = list(request.user.groups.all().values_list("name", flat=True))
-    for permission in object.get_required_permissions():
-        if permission not in groups:
-            return permission.group.name
+    """
+    Returns the name of a group which the object (an Endpoint, registry
+    Endpoint or PrebuiltView) requires and the requesting user is not in,
+    or None if the user may access it.
+    """
+    required = object.get_required_groups()
+    if not required:
+        return None
+    missing = required - get_user_groups(request)
+    if missing:
+        return sorted(missing)[0]
@@ -1,22 +1,55 @@
-from django.http import HttpResponseForbidden
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import (HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+                         HttpResponseServerError)
 from django.utils.html import escape
 from djangohelpers import allow_http
+from functools import partial
+import time
 import urllib
 
-from apihangar.models import Endpoint, PrebuiltView
-from apihangar.utils import json_dumps, unescape, render_response, check_permission
-from apihangar.registry import registry
+from apihangar.caching import (CachedResponse, cache_stats, cached_call,
+                               response_cache_key)
+from apihangar.export import EXPORT_TYPES, export_supported, render_export, tabulate
+from apihangar.governor import QueryRejected, RowLimitExceeded
+from apihangar.instrumentation import metrics, record_response, server_timing
+from apihangar.metadata import resolve_endpoint, resolve_view
+from apihangar.parallel import run_all, use_concurrency
+from apihangar.routing import pool_status
+from apihangar.utils import (json_dumps, json_loads, unescape, render_response,
+                             check_permission, request_flag, request_result_format,
+                             find_streams, ClosingIterator, RESULT_FORMATS, SortedDict)
+from apihangar.warming import get_materialized
+
+def governed(func):
+    """
+    Turns queries refused or aborted by the governor into 503 Service
+    Unavailable and 500 Internal Server Error responses.
+    """
+    def inner(request, *args, **kwargs):
+        try:
+            return func(request, *args, **kwargs)
+        except QueryRejected:
+            response = HttpResponse("Too many queries in progress, please retry",
+                                    status=503, content_type="text/plain")
+            response["Retry-After"] = "1"
+            return response
+        except RowLimitExceeded as e:
+            return HttpResponseServerError(str(e), content_type="text/plain")
+    inner.__name__ = func.__name__
+    return inner
 
 @allow_http("GET")
 def retrieve_endpoint_form(request, api_url, response_type="json"):
-    endpoint = registry.get(api_url) or Endpoint.objects.get(url=api_url)
+    endpoint = resolve_endpoint(api_url)
 
     if check_permission(request, endpoint) is not None:
         return HttpResponseForbidden()
 
     variables = set()
-    for apiquery in endpoint.endpoint_queries.all().select_related():
-        variables.update(apiquery.query.get_variables())
+    for query in endpoint.get_queries():
+        variables.update(query.get_variables())
     variables = list(variables)
 
     return render_response(request, response_type,
@@ -25,27 +58,76 @@ def retrieve_endpoint_form(request, api_url, response_type="json"):
     )
 
 @allow_http("GET")
+@governed
 def execute_view(request, view_url):
-    view = PrebuiltView.objects.select_related("endpoint").get(url=view_url)
+    view = resolve_view(view_url)
 
     if check_permission(request, view) is not None:
         return HttpResponseForbidden()
 
-    json = view.endpoint.run(params=view.load_params())
+    default_template = view.template or 'apihangar/default_template.html'
+    if view.refresh_seconds:
+        materialized = get_materialized(view)
+        if materialized is not None:
+            return _render_materialized(request, view, materialized, default_template)
+
+    executions = []
+    json = view.endpoint.run(params=view.load_params(), executions=executions)
+
+    return _render_instrumented(request, view.endpoint.url, view.response_type, json,
+                                executions, default_template=default_template)
+
+def _render_materialized(request, view, materialized, default_template):
+    ## The stored JSON can be sent as it is, unless it needs
+    ## re-rendering as HTML, JSONP or pretty-printed JSON.
+    if (view.response_type == "json" and not request_flag(request, "pretty")
+            and not (request.GET.get("jsonp") or request.GET.get("callback"))):
+        response = HttpResponse(materialized.content, content_type="application/json")
+    else:
+        response = render_response(request, view.response_type,
+                                   json_loads(materialized.content),
+                                   default_template=default_template)
+    response["Age"] = "%d" % max(0, materialized.age())
+    return response
 
-    return render_response(request, response_type, json)
-    
 @allow_http("GET")
+@governed
 def execute_endpoint(request, api_url, response_type="json"):
-    endpoint = registry.get(api_url) or Endpoint.objects.get(url=api_url)
+    endpoint = resolve_endpoint(api_url)
 
     if check_permission(request, endpoint) is not None:
         return HttpResponseForbidden()
 
+    if response_type in EXPORT_TYPES:
+        return _export_endpoint(request, endpoint, response_type)
+
+    timeout = endpoint.response_cache_seconds
+    stream = response_type == "json" and request_flag(request, "stream")
+    if not timeout or stream:
+        return _execute_endpoint(request, endpoint, response_type, stream)
+
+    cache_name = getattr(settings, 'APIHANGAR_CACHE', "default")
+    cached = cached_call(caches[cache_name],
+                         response_cache_key(api_url, response_type, request),
+                         timeout,
+                         lambda: CachedResponse(
+                             _execute_endpoint(request, endpoint, response_type),
+                             timeout))
+    return cached.to_response(request, private=bool(endpoint.get_required_groups()))
+
+def parse_params(items, unquote=True):
+    """
+    Converts (key, value) request parameters into query parameters,
+    casting values according to their keys' "int:" and "list:" prefixes.
+    Pass `unquote=False` for parameters which weren't URL-encoded.
+    """
     params = {}
-    for key in request.GET.keys():
-        value = unescape(urllib.unquote(request.GET[key]))
-        key = unescape(urllib.unquote(key))
+    for key, value in items:
+        if unquote:
+            value = urllib.unquote(value)
+            key = urllib.unquote(key)
+        value = unescape(value)
+        key = unescape(key)
 
         if key.startswith("list:"):
             key = key[5:]
@@ -64,7 +146,182 @@ def execute_endpoint(request, api_url, response_type="json"):
                     continue
             else:
                 params[key] = str(value.strip())
-    
-    json = endpoint.run(params=params)
+    return params
+
+def _execute_endpoint(request, endpoint, response_type, stream=False):
+    params = parse_params(request.GET.items())
+    result_format = request_result_format(request)
+    executions = []
+    json = endpoint.run(params=params, stream=stream, result_format=result_format,
+                        executions=executions)
+
+    return _render_instrumented(request, endpoint.url, response_type, json, executions,
+                                stream=stream)
+
+def _export_endpoint(request, endpoint, response_type):
+    ## Exports always stream one query's rows, as they come from the
+    ## cursor; the query is chosen with the "key" parameter, which may
+    ## be left out if the endpoint only has one.
+    keys = endpoint.get_keys()
+    key = request.GET.get("key")
+    if key is None and len(keys) == 1:
+        key = keys[0]
+    if key not in keys:
+        return HttpResponseBadRequest("Choose one of these keys with key=: %s"
+                                      % ", ".join(keys), content_type="text/plain")
+    if not export_supported(response_type):
+        return HttpResponse("This export type isn't available on this server",
+                            status=501, content_type="text/plain")
+
+    executions = []
+    json = endpoint.run(params=parse_params(request.GET.items()), stream=True,
+                        result_format="columns", executions=executions, keys=[key])
+    columns, chunks = tabulate(json["results"][key], key)
+
+    started = time.time()
+    response = render_export(response_type, key, columns, chunks)
+    _close_streams_with(response, json)
+    response.streaming_content = _counted(
+        response.streaming_content, endpoint.url, response_type, started)
+    timing = server_timing(executions)
+    if timing:
+        response["Server-Timing"] = timing
+    return response
+
+def _render_instrumented(request, endpoint_url, response_type, json, executions, **kw):
+    ## Render the response, recording how long it took to serialize and
+    ## how large it was -- for streams, once the last chunk is sent.
+    started = time.time()
+    response = render_response(request, response_type, json, **kw)
+    if response.streaming:
+        _close_streams_with(response, json)
+        response.streaming_content = _counted(
+            response.streaming_content, endpoint_url, response_type, started)
+        timing = server_timing(executions)
+    else:
+        if hasattr(response, "render"):
+            response.render()
+        seconds = time.time() - started
+        record_response(endpoint_url, response_type, len(response.content), seconds)
+        timing = server_timing(executions, seconds)
+    if timing:
+        response["Server-Timing"] = timing
+    return response
 
-    return render_response(request, response_type, json)
+def _close_streams_with(response, json):
+    ## Close any streams the response hasn't finished with when it is
+    ## closed (say, because the client went away), so that their
+    ## cursors and turns at the database are given back.
+    streams = find_streams(json)
+    if streams:
+        response.streaming_content = ClosingIterator(response.streaming_content, streams)
+
+def _counted(chunks, endpoint_url, response_type, started):
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        yield chunk
+    record_response(endpoint_url, response_type, size, time.time() - started)
+
+def _batch_items(body):
+    ## A batch is a list of {"endpoint": url, "params": {...}} items,
+    ## each optionally with a "key" (by default, its position), or a
+    ## dict of such items by key.
+    if isinstance(body, dict):
+        items = [(key, item) for key, item in body.items()]
+    elif isinstance(body, (list, tuple)):
+        items = [(item.get("key", str(i)) if isinstance(item, dict) else str(i), item)
+                 for i, item in enumerate(body)]
+    else:
+        raise ValueError("Expected a list or object of batch items")
+    for key, item in items:
+        if not isinstance(item, dict) or not item.get("endpoint"):
+            raise ValueError("Batch item %s has no endpoint" % key)
+        if not isinstance(item.get("params", {}), dict):
+            raise ValueError("Batch item %s has invalid params" % key)
+    return items
+
+def _batch_params(params):
+    ## Params are given as in a query string, but JSON lists
+    ## may be used for list: parameters.
+    items = []
+    for key, value in params.items():
+        if isinstance(value, (list, tuple)):
+            value = ",".join("%s" % i for i in value)
+        items.append((key, "%s" % value))
+    return parse_params(items, unquote=False)
+
+@allow_http("POST")
+@governed
+def execute_batch(request):
+    """
+    Runs several endpoints for one request, and returns their results
+    in a single JSON document keyed by item.  Each endpoint is resolved
+    and permission-checked once, however many items use it; items whose
+    endpoint doesn't exist or may not be accessed get an error instead
+    of a result.
+    """
+    try:
+        items = _batch_items(json_loads(request.body.decode("utf-8")))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e), content_type="text/plain")
+    max_items = getattr(settings, 'APIHANGAR_MAX_BATCH_ITEMS', 20)
+    if max_items is not None and len(items) > max_items:
+        return HttpResponseBadRequest("At most %d items may be batched" % max_items,
+                                      content_type="text/plain")
+
+    endpoints = {}
+    errors = {}
+    for key, item in items:
+        url = item["endpoint"]
+        if url in endpoints or url in errors:
+            continue
+        try:
+            endpoint = resolve_endpoint(url)
+        except ObjectDoesNotExist:
+            errors[url] = "not found"
+            continue
+        if check_permission(request, endpoint) is not None:
+            errors[url] = "forbidden"
+        else:
+            endpoints[url] = endpoint
+
+    result_format = request_result_format(request)
+    results = SortedDict()
+    calls = []
+    executions = []
+    for key, item in items:
+        if item["endpoint"] in errors:
+            results[key] = {"error": errors[item["endpoint"]]}
+            continue
+        endpoint = endpoints[item["endpoint"]]
+        format = item.get("format")
+        if format not in dict(RESULT_FORMATS):
+            format = result_format
+        results[key] = None
+        calls.append((key, partial(endpoint.run, params=_batch_params(item.get("params", {})),
+                                   result_format=format, executions=executions)))
+
+    ## Items run side by side when all of their endpoints allow it; each
+    ## endpoint's own queries then run one after another in its thread.
+    concurrent = all(use_concurrency(endpoint.concurrent_queries)
+                     for endpoint in endpoints.values())
+    outputs = run_all([call for key, call in calls], concurrent=concurrent)
+    for (key, call), output in zip(calls, outputs):
+        results[key] = output
+
+    return _render_instrumented(request, "batch", "json", {"results": results},
+                                executions)
+
+@allow_http("GET")
+def query_metrics(request):
+    """
+    Returns the in-process execution metrics for every endpoint and
+    query, for staff users only.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    summary = metrics.summary()
+    summary["pools"] = pool_status()
+    summary["cache"] = cache_stats()
+    return render_response(request, "json", summary)
@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.core.cache import caches
+from hashlib import md5 as md5_constructor
+import logging
+import time
+
+from apihangar.models import PrebuiltView
+from apihangar.utils import json_dumps
+
+__all__ = ["MaterializedView", "get_materialized", "warm_view", "warm_views"]
+
+logger = logging.getLogger("apihangar.warming")
+
+class MaterializedView(object):
+    "The serialized results of a PrebuiltView, and when they were computed."
+    def __init__(self, content, warmed_at):
+        self.content = content
+        self.warmed_at = warmed_at
+
+    def age(self):
+        return time.time() - self.warmed_at
+
+def _cache():
+    return caches[getattr(settings, 'APIHANGAR_CACHE', "default")]
+
+def _key(view):
+    return "apihangar.view.%s" % md5_constructor(view.url.encode("utf-8")).hexdigest()
+
+def get_materialized(view):
+    "Returns the view's MaterializedView, or None if it hasn't been warmed"
+    materialized = _cache().get(_key(view))
+    if isinstance(materialized, MaterializedView):
+        return materialized
+    return None
+
+def warm_view(view):
+    """
+    Runs the view's endpoint with its params and stores the serialized
+    results.  They are kept for twice the view's refresh_seconds, so
+    that one late refresh doesn't send requests back to the database.
+    """
+    json = view.endpoint.run(params=view.load_params())
+    materialized = MaterializedView(json_dumps(json), time.time())
+    _cache().set(_key(view), materialized, 2 * view.refresh_seconds)
+    return materialized
+
+def warm_views(urls=None, force=False):
+    """
+    Warms every PrebuiltView with a refresh_seconds (or only those at
+    `urls`) whose results are missing or older than that, or all of them
+    with `force`, and returns the views warmed.  Each view is warmed by
+    one process at a time, so several workers can share the job.  A view
+    which fails to warm is logged and skipped, keeping its old results.
+    """
+    views = PrebuiltView.objects.filter(refresh_seconds__isnull=False).select_related("endpoint")
+    if urls:
+        views = views.filter(url__in=urls)
+
+    cache = _cache()
+    warmed = []
+    for view in views:
+        if view.refresh_seconds <= 0:
+            continue
+        materialized = get_materialized(view)
+        if (not force and materialized is not None
+                and materialized.age() < view.refresh_seconds):
+            continue
+        lock_key = "%s.lock" % _key(view)
+        if not cache.add(lock_key, 1, view.refresh_seconds):
+            continue
+        try:
+            warm_view(view)
+        except Exception:
+            logger.exception("Couldn't warm the prebuilt view %s", view.url)
+            continue
+        finally:
+            cache.delete(lock_key)
+        warmed.append(view)
+    return warmed
@@ -4,13 +4,14 @@ import sys, os
 version = '0.1.1'
 
 install_requires = [
-    "django-templateinspector",
     "djangohelpers",
     ]
 
 import sys
 if sys.version_info[:2] < (2, 7):
     install_requires.append("simplejson")
+if sys.version_info[:2] < (3, 2):
+    install_requires.append("futures")
 
 setup(name='django-apihangar',
       version=version,